@@ -3,6 +3,7 @@
 
 select 
     row_hash,
+    row_fingerprint,
     name,
     age,
     date
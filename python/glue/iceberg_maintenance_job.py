@@ -0,0 +1,181 @@
+import sys
+import logging
+import boto3
+import traceback
+from datetime import datetime, timedelta, timezone
+
+from awsglue.utils import getResolvedOptions
+from pyspark.context import SparkContext
+from awsglue.context import GlueContext
+
+# Logging
+MSG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+logging.basicConfig(format=MSG_FORMAT, datefmt=DATETIME_FORMAT)
+logger = logging.getLogger("glue-log")
+logger.setLevel(logging.INFO)
+
+
+# Constants and Config
+CATALOG = "glue_catalog"
+# Tables with a write order are compacted with the sort strategy so rewritten
+# files keep it, the rest are bin-packed
+REWRITE_STRATEGIES = {
+    "metadata.data_ingest_log": "binpack",
+    "metadata.data_process_log": "binpack",
+    "cleansed.openpowerlifting": "sort",
+}
+
+sns = boto3.client("sns")
+
+
+def get_file_stats(spark, table: str) -> dict:
+    # Files in the current snapshot, content 0 is data and 1 and 2 are deletes
+    row = spark.sql(f"""
+        SELECT
+            count_if(content = 0) AS data_files,
+            count_if(content != 0) AS delete_files,
+            coalesce(sum(file_size_in_bytes), 0) AS total_bytes
+        FROM {CATALOG}.{table}.files
+    """).collect()[0]
+    return row.asDict()
+
+
+def format_file_stats(stats: dict) -> str:
+    return f"{stats['data_files']} data files, {stats['delete_files']} delete files, {stats['total_bytes']} bytes"
+
+
+def maintain_table(
+    spark,
+    table: str,
+    strategy: str,
+    snapshot_retention_days: int,
+    retain_last: int,
+    orphan_retention_days: int,
+) -> None:
+    now = datetime.now(timezone.utc)
+    expire_before = (now - timedelta(days=snapshot_retention_days)).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+    orphans_before = (now - timedelta(days=orphan_retention_days)).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+
+    # Compacts small files and rewrites any data file with deletes against it,
+    # so the deletes are applied and can be dropped
+    logger.info(f"Rewriting data files for {table} with {strategy} strategy")
+    row = spark.sql(f"""
+        CALL {CATALOG}.system.rewrite_data_files(
+            table => '{table}',
+            strategy => '{strategy}',
+            options => map('min-input-files', '2', 'delete-file-threshold', '1')
+        )
+    """).collect()[0]
+    logger.info(
+        f"Rewrote {row['rewritten_data_files_count']} data files ({row['rewritten_bytes_count']} bytes) into {row['added_data_files_count']} files"
+    )
+
+    logger.info(f"Rewriting position delete files for {table}")
+    row = spark.sql(f"""
+        CALL {CATALOG}.system.rewrite_position_delete_files(table => '{table}')
+    """).collect()[0]
+    logger.info(
+        f"Rewrote {row['rewritten_delete_files_count']} position delete files into {row['added_delete_files_count']} files"
+    )
+
+    logger.info(f"Rewriting manifests for {table}")
+    spark.sql(f"CALL {CATALOG}.system.rewrite_manifests(table => '{table}')")
+
+    logger.info(f"Expiring snapshots of {table} older than {expire_before}")
+    row = spark.sql(f"""
+        CALL {CATALOG}.system.expire_snapshots(
+            table => '{table}',
+            older_than => TIMESTAMP '{expire_before}',
+            retain_last => {retain_last}
+        )
+    """).collect()[0]
+    logger.info(
+        f"Expired snapshots removed {row['deleted_data_files_count']} data files and {row['deleted_position_delete_files_count']} position delete files"
+    )
+
+    # Only files older than the retention window are candidates, so files from
+    # writes still in flight are left alone
+    logger.info(f"Removing orphan files of {table} older than {orphans_before}")
+    orphan_files = spark.sql(f"""
+        CALL {CATALOG}.system.remove_orphan_files(
+            table => '{table}',
+            older_than => TIMESTAMP '{orphans_before}'
+        )
+    """).collect()
+    logger.info(f"Removed {len(orphan_files)} orphan files")
+    return
+
+
+def main():
+    try:
+        job_status = ""
+        message = ""
+
+        sc = SparkContext.getOrCreate()
+        glueContext = GlueContext(sc)
+        spark = glueContext.spark_session
+        args = getResolvedOptions(
+            sys.argv,
+            [
+                "JOB_NAME",
+                "sns_topic_arn",
+                "tables",
+                "snapshot_retention_days",
+                "retain_last",
+                "orphan_retention_days",
+            ],
+        )
+        job_name = args["JOB_NAME"]
+        sns_topic_arn = args["sns_topic_arn"]
+        tables = [x.strip() for x in args["tables"].split(",") if x.strip()]
+        snapshot_retention_days = int(args["snapshot_retention_days"])
+        retain_last = int(args["retain_last"])
+        orphan_retention_days = int(args["orphan_retention_days"])
+
+        report = []
+        for table in tables:
+            before = get_file_stats(spark, table)
+            logger.info(f"{table} before maintenance: {format_file_stats(before)}")
+
+            maintain_table(
+                spark,
+                table,
+                REWRITE_STRATEGIES.get(table, "binpack"),
+                snapshot_retention_days,
+                retain_last,
+                orphan_retention_days,
+            )
+
+            after = get_file_stats(spark, table)
+            logger.info(f"{table} after maintenance: {format_file_stats(after)}")
+            report.append(
+                f"{table}\n  before: {format_file_stats(before)}\n  after:  {format_file_stats(after)}"
+            )
+
+        job_status = "SUCCESS"
+        message = "\n\n" + "\n\n".join(report) + "\n\n"
+        return
+
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        job_status = "FAILURE"
+        message = f"\n\nJob failed:\n\n{traceback.format_exc()}"
+        raise e
+
+    finally:
+        logger.info(message)
+        logger.info("Sending SNS notification")
+        sns.publish(
+            TopicArn=sns_topic_arn,
+            Subject=f"Glue Job {job_name}: {job_status}",
+            Message=message,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,38 @@ import sys
 import logging
 import boto3
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
 from pyspark.context import SparkContext
 from awsglue.context import GlueContext
-from pyspark.sql.functions import lit, concat_ws, current_timestamp, coalesce, sha2
+from pyspark.sql import DataFrame, Window
+from pyspark.sql.functions import (
+    broadcast,
+    col,
+    lit,
+    concat_ws,
+    current_timestamp,
+    coalesce,
+    input_file_name,
+    regexp_replace,
+    row_number,
+    sha2,
+    xxhash64,
+)
 
+from utils.common import check_conditional_writes
+from utils.schema import OPENPOWERLIFTING_COLUMNS, OPENPOWERLIFTING_HEADER
 from utils.processing import (
-    get_process_event_id_hwm,
+    get_last_file_event,
     get_latest_ingest_event_id,
-    run_athena_query,
-    insert_row_to_process_log,
+    get_pending_event_ids,
+    read_pending_events,
+    ConsumerCheckpoint,
+    IngestEvent,
+    ProcessLogWriter,
 )
 
 # Logging
@@ -34,51 +53,11 @@ SOURCE_TABLE = "openpowerlifting"
 SOURCE_SYSTEM = "Openpowerlifting.org"
 TARGET_DB = "cleansed"
 TARGET_TABLE = "openpowerlifting"
-
-RENAME_COLS_MAP = {
-    "Name": "name",
-    "Sex": "sex",
-    "Event": "event",
-    "Equipment": "equipment",
-    "Age": "age",
-    "AgeClass": "age_class",
-    "BirthYearClass": "birth_year_class",
-    "Division": "division",
-    "BodyweightKg": "bodyweight_kg",
-    "WeightClassKg": "weightclass_kg",
-    "Squat1Kg": "squat_1_kg",
-    "Squat2Kg": "squat_2_kg",
-    "Squat3Kg": "squat_3_kg",
-    "Squat4Kg": "squat_4_kg",
-    "Best3SquatKg": "best_3_squat_kg",
-    "Bench1Kg": "bench_1_kg",
-    "Bench2Kg": "bench_2_kg",
-    "Bench3Kg": "bench_3_kg",
-    "Bench4Kg": "bench_4_kg",
-    "Best3BenchKg": "best_3_bench_kg",
-    "Deadlift1Kg": "deadlift_1_kg",
-    "Deadlift2Kg": "deadlift_2_kg",
-    "Deadlift3Kg": "deadlift_3_kg",
-    "Deadlift4Kg": "deadlift_4_kg",
-    "Best3DeadliftKg": "best_3_deadlift_kg",
-    "TotalKg": "total_kg",
-    "Place": "place",
-    "Dots": "dots",
-    "Wilks": "wilks",
-    "Glossbrenner": "glossbrenner",
-    "Goodlift": "goodlift",
-    "Tested": "tested",
-    "Country": "country",
-    "State": "state",
-    "Federation": "federation",
-    "ParentFederation": "parent_federation",
-    "Date": "date",
-    "MeetCountry": "meet_country",
-    "MeetState": "meet_state",
-    "MeetTown": "meet_town",
-    "MeetName": "meet_name",
-    "Sanctioned": "sanctioned",
-}
+PROCESS_LOG_FLUSH_EVERY = 50
+SOURCE_FILE_COL = "_source_file"
+SOURCE_EVENT_COL = "_source_event_id"
+ROW_KEYS = ("row_hash", "row_fingerprint")
+LAST_EVENT_PROPERTY = "last_event_id"
 
 athena = boto3.client("athena")
 glue = boto3.client("glue")
@@ -86,137 +65,387 @@ s3 = boto3.client("s3")
 sns = boto3.client("sns")
 
 
+def batched(events, batch_size: int):
+    batch = []
+    for event in events:
+        batch.append(event)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def strip_scheme(column):
+    # The reader may report s3a:// or s3n:// for an s3:// location
+    return regexp_replace(column, "^s3[an]?://", "")
+
+
+def get_source_location(event: IngestEvent) -> str:
+    # Prefer the all-string Parquet copy written at ingest when there is one
+    return event.payload.get("parquet_s3_location") or event.s3_location
+
+
+def read_source_files(spark, events: list[IngestEvent]) -> DataFrame:
+    # Reads every file in one pass per format and tags each row with the event
+    # that delivered it. CSV fields are all read as strings, like the Parquet
+    # copies.
+    csv_paths = [
+        x.s3_location for x in events if "parquet_s3_location" not in x.payload
+    ]
+    parquet_paths = [
+        x.payload["parquet_s3_location"]
+        for x in events
+        if "parquet_s3_location" in x.payload
+    ]
+
+    frames = []
+    if csv_paths:
+        frames.append(
+            spark.read.csv(csv_paths, header=True, escape='"').withColumn(
+                SOURCE_FILE_COL, input_file_name()
+            )
+        )
+    if parquet_paths:
+        frames.append(
+            spark.read.parquet(*parquet_paths).withColumn(
+                SOURCE_FILE_COL, input_file_name()
+            )
+        )
+    df = frames[0]
+    for frame in frames[1:]:
+        df = df.unionByName(frame)
+
+    events_df = spark.createDataFrame(
+        [(get_source_location(x), x.event_id) for x in events],
+        [SOURCE_FILE_COL, SOURCE_EVENT_COL],
+    )
+    df = df.withColumn(SOURCE_FILE_COL, strip_scheme(col(SOURCE_FILE_COL)))
+    events_df = events_df.withColumn(
+        SOURCE_FILE_COL, strip_scheme(col(SOURCE_FILE_COL))
+    )
+    return df.join(broadcast(events_df), [SOURCE_FILE_COL]).drop(SOURCE_FILE_COL)
+
+
+def add_row_keys(df: DataFrame) -> DataFrame:
+    # Both keys are taken over the raw strings. row_hash is kept for existing
+    # consumers while they migrate to the 64-bit row_fingerprint.
+    source_values = [coalesce(col(x), lit("")) for x in OPENPOWERLIFTING_HEADER]
+    df = df.withColumn("row_hash", sha2(concat_ws(":", *source_values), 256))
+    return df.withColumn("row_fingerprint", xxhash64(*source_values))
+
+
+def get_current_snapshot(spark, table: str):
+    rows = spark.sql(f"""
+        SELECT snapshot_id, summary
+        FROM {table}.snapshots
+        ORDER BY committed_at DESC
+        LIMIT 1
+    """).collect()
+    return rows[0] if rows else None
+
+
+def get_committed_event_id(spark, table: str) -> int:
+    # Highest event id recorded on a load snapshot. Loads commit before the
+    # checkpoint moves, so a retry can find rows it already appended.
+    row = spark.sql(f"""
+        SELECT max(cast(summary['{LAST_EVENT_PROPERTY}'] AS BIGINT)) AS event_id
+        FROM {table}.snapshots
+    """).collect()[0]
+    return row["event_id"] if row["event_id"] is not None else -1
+
+
+def mark_deleted_rows(spark, table: str, row_key: str, latest_df: DataFrame) -> int:
+    # Live keys missing from the latest file, found with a shuffled anti-join
+    # on the key rather than a NOT IN over the whole table. The table is
+    # partitioned by meet year, so both this and the MERGE read the key column
+    # of every data file.
+    latest_keys = latest_df.select(row_key).distinct()
+    live_keys = spark.table(table).where(~col("is_deleted")).select(row_key)
+    deleted_keys = live_keys.join(latest_keys, [row_key], "left_anti").cache()
+    num_rows_deleted = deleted_keys.count()
+
+    # With merge-on-read the MERGE only writes delete files and new rows for the
+    # matched keys instead of rewriting every data file
+    if num_rows_deleted > 0:
+        deleted_keys.createOrReplaceTempView("deleted_keys")
+        spark.sql(f"""
+            MERGE INTO {table} t
+            USING deleted_keys s
+            ON t.{row_key} = s.{row_key} AND NOT t.is_deleted
+            WHEN MATCHED THEN UPDATE SET is_deleted = true
+        """)
+    deleted_keys.unpersist()
+    return num_rows_deleted
+
+
 def main():
+    process_log = None
     try:
         logger.info("Beginning job, loading arguments.")
 
         sc = SparkContext.getOrCreate()
         glueContext = GlueContext(sc)
         spark = glueContext.spark_session
-        args = getResolvedOptions(sys.argv, ["JOB_NAME", "sns_topic_arn"])
+        args = getResolvedOptions(
+            sys.argv,
+            [
+                "JOB_NAME",
+                "sns_topic_arn",
+                "state_bucket",
+                "sequence_bucket",
+                "max_batch_files",
+                "row_key",
+            ],
+        )
         job_name = args["JOB_NAME"]
         job_id = args["JOB_ID"]
         job_run_id = args["JOB_RUN_ID"]
         sns_topic_arn = args["sns_topic_arn"]
+        state_bucket = args["state_bucket"]
+        sequence_bucket = args["sequence_bucket"]
+        max_batch_files = int(args["max_batch_files"])
+        row_key = args["row_key"]
+        if row_key not in ROW_KEYS:
+            raise ValueError(f"row_key must be one of {ROW_KEYS}, got {row_key}")
+        target_table = f"glue_catalog.{TARGET_DB}.{TARGET_TABLE}"
+        check_conditional_writes(s3)
 
         total_events_processed = 0
         total_opl_events_processed = 0
         total_rows_processed = 0
+        total_rows_deleted = 0
 
         logger.info(f"Reading new events")
 
-        event_id_hwm = get_process_event_id_hwm(job_name, athena)
-        latest_event_id = get_latest_ingest_event_id(athena)
+        checkpoint = ConsumerCheckpoint(job_name, s3, state_bucket)
+
+        # Independent lookups, run concurrently so their latencies overlap.
+        # All of them finish before the events are read.
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            event_id_hwm_future = pool.submit(checkpoint.read, athena)
+            latest_event_id_future = pool.submit(get_latest_ingest_event_id, athena)
+            pending_event_ids_future = pool.submit(
+                get_pending_event_ids, s3, sequence_bucket, f"{LOG_DB}.{EVENTS_LOG}"
+            )
+        event_id_hwm = event_id_hwm_future.result()
+        latest_event_id = latest_event_id_future.result()
+        pending_event_ids = pending_event_ids_future.result()
 
         if latest_event_id == -1:
             raise ValueError("The event log is empty.")
 
-        if event_id_hwm == latest_event_id:
+        # Events are only read up to the first id a producer still holds, so
+        # the hwm never moves past a row that has yet to land
+        max_event_id = latest_event_id
+        for event_id in pending_event_ids:
+            if event_id_hwm < event_id <= latest_event_id:
+                max_event_id = event_id - 1
+                logger.info(
+                    f"Event #{event_id} is allocated but not logged yet, reading events up to #{max_event_id}"
+                )
+                break
+
+        if event_id_hwm >= max_event_id:
             job_status = "NO NEW EVENTS"
             message = "No new events to process."
             return
 
-        events_to_process = list(range(event_id_hwm + 1, latest_event_id + 1))
+        process_log = ProcessLogWriter(
+            job_name,
+            athena,
+            PROCESS_LOG_FLUSH_EVERY,
+            log_table=f"{LOG_DB}.{PROCESS_LOG}",
+            event_id_hwm=event_id_hwm,
+            checkpoint=checkpoint,
+        )
 
-        for event_id in events_to_process:
-            s3_location_sql = f"""
-                select coalesce(json_extract_scalar(payload, '$.s3_location'), 'invalid') as filename
-                from {LOG_DB}.{EVENTS_LOG} 
-                where event_id = {event_id}
-                limit 1
-            """
-            filename = run_athena_query(s3_location_sql, athena)["Rows"][0][0][
-                "VarCharValue"
-            ]
+        pending_events = read_pending_events(
+            event_id_hwm,
+            athena,
+            max_event_id=max_event_id,
+            log_table=f"{LOG_DB}.{EVENTS_LOG}",
+        )
 
-            if filename == "invalid":
-                logger.info(
-                    f"Adding row to metadata.data_process_log for event #{event_id}, filename: {filename}"
-                )
-                insert_row_to_process_log(
-                    job_name, event_id, event_id_hwm, job_run_id, athena
-                )
-                total_events_processed += 1
-                continue
-
-            logger.info(f"Processing event #{event_id}, file: {filename}")
-            logger.info("Reading source file into Spark DF")
-            df = glueContext.create_data_frame.from_options(
-                connection_type="s3",
-                connection_options={"paths": [filename]},
-                format="csv",
-                format_options={"withHeader": True},
-            )
-            source_num_rows = df.count()
-            logger.info(f"Number of rows in source {filename}: {source_num_rows}")
-
-            logger.info("Dropping duplicates and rows existing in target")
-            df = df.withColumn(
-                "row_hash",
-                sha2(
-                    concat_ws(
-                        ":",
-                        *[coalesce(col, lit("")).alias(col) for col in df.schema.names],
-                    ),
-                    256,
-                ),
-            )
-            df = df.dropDuplicates(["row_hash"])
-            target_rows_df = spark.sql(
-                f"SELECT row_hash FROM glue_catalog.{TARGET_DB}.{TARGET_TABLE}"
-            )
-            df = (
-                df.join(target_rows_df, ["row_hash"], "leftouter")
-                .where(target_rows_df["row_hash"].isNull())
-                .drop(target_rows_df["row_hash"])
-            )
-            filtered_num_rows = df.count()
+        # Pending files are processed max_batch_files at a time, each batch in
+        # a single read and commit. A batch size of 1 processes one file per
+        # pass.
+        previous_file_event = get_last_file_event(
+            event_id_hwm, athena, log_table=f"{LOG_DB}.{EVENTS_LOG}"
+        )
+
+        # A failed run can commit a load and stop before the checkpoint moves.
+        # Rows from events up to the last committed one are not loaded again.
+        committed_event_id = get_committed_event_id(spark, target_table)
+        if committed_event_id > event_id_hwm:
             logger.info(
-                f"Number of rows that will be loaded to target: {filtered_num_rows}"
+                f"Events up to #{committed_event_id} are already loaded to the target, only their process-log rows and soft deletes are redone"
             )
 
-            if filtered_num_rows > 0:
+        next_event_id = event_id_hwm + 1
+        for batch in batched(pending_events, max_batch_files):
+            file_events = []
+            for event in batch:
+                # Gaps below max_event_id were released without a row
+                if event.event_id > next_event_id:
+                    logger.info(
+                        f"Skipping event ids #{next_event_id} to #{event.event_id - 1}, abandoned by their producer"
+                    )
+                next_event_id = event.event_id + 1
+                if event.s3_location is None:
+                    logger.info(
+                        f"Event #{event.event_id} has no file, filename: invalid"
+                    )
+                else:
+                    file_events.append(event)
+
+            if file_events:
+                for event in file_events:
+                    logger.info(
+                        f"Processing event #{event.event_id}, file: {get_source_location(event)}"
+                    )
+                logger.info(f"Reading {len(file_events)} source files into Spark DF")
+                df = read_source_files(spark, file_events)
+                source_columns = [x for x in df.schema.names if x != SOURCE_EVENT_COL]
+                if source_columns != OPENPOWERLIFTING_HEADER:
+                    raise ValueError(
+                        f"Header mismatch. \nExpected: {OPENPOWERLIFTING_HEADER} \nFound: {source_columns}"
+                    )
+
+                logger.info("Dropping duplicates and rows existing in target")
+                hashed_df = add_row_keys(df).cache()
+
+                # Rows are matched to events on their file path, a file that
+                # matches no event would otherwise drop out unnoticed
+                event_read_counts = {
+                    row[SOURCE_EVENT_COL]: row["count"]
+                    for row in hashed_df.groupBy(SOURCE_EVENT_COL).count().collect()
+                }
+                empty_events = [
+                    x.event_id
+                    for x in file_events
+                    if not event_read_counts.get(x.event_id)
+                ]
+                if empty_events:
+                    raise ValueError(
+                        f"No rows read for events {empty_events}, check that their files exist at the logged locations"
+                    )
+
+                # Keep the first event that delivered each row
+                first_seen = Window.partitionBy(row_key).orderBy(SOURCE_EVENT_COL)
+                df = (
+                    hashed_df.withColumn("_row_number", row_number().over(first_seen))
+                    .where(col("_row_number") == 1)
+                    .drop("_row_number")
+                )
+
+                # Every row of the previous file is already in the target, so
+                # only rows missing from it are new. This compares against one
+                # dump instead of the whole target history. Without an earlier
+                # file the keys of the whole target are read instead.
+                if previous_file_event is not None:
+                    logger.info(
+                        f"Dropping rows found in the previous file, event #{previous_file_event.event_id}: {get_source_location(previous_file_event)}"
+                    )
+                    existing_keys = add_row_keys(
+                        read_source_files(spark, [previous_file_event])
+                    ).select(row_key)
+                else:
+                    existing_keys = spark.table(target_table).select(row_key)
+                df = df.join(existing_keys, [row_key], "left_anti")
+
+                # Rows first delivered by an already committed event were
+                # loaded by the run that committed it
+                df = df.where(col(SOURCE_EVENT_COL) > committed_event_id)
+
+                event_row_counts = {
+                    row[SOURCE_EVENT_COL]: row["count"]
+                    for row in df.groupBy(SOURCE_EVENT_COL).count().collect()
+                }
+                for event in file_events:
+                    logger.info(
+                        f"Number of new rows from event #{event.event_id}: {event_row_counts.get(event.event_id, 0)}"
+                    )
+
+                # Hashes are taken over the raw strings above, the target gets the
+                # typed columns
+                logger.info("Casting columns to the target schema")
+                load_df = df.select(
+                    *[
+                        col(x.source_name).cast(x.type).alias(x.name)
+                        for x in OPENPOWERLIFTING_COLUMNS
+                    ],
+                    "row_hash",
+                    "row_fingerprint",
+                )
+
                 logger.info("Adding audit columns")
-                df = df.withColumn("source_system", lit(SOURCE_SYSTEM))
-                df = df.withColumn("source_table", lit(f"{SOURCE_DB}.{SOURCE_TABLE}"))
-                df = df.withColumn("inserted_at", current_timestamp())
-                df = df.withColumn("job_name", lit(job_name))
-                df = df.withColumn("job_id", lit(job_id))
-                df = df.withColumn("job_run_id", lit(job_run_id))
-                df = df.withColumn("is_deleted", lit(False))
-
-                logger.info("Renaming columns from camel to snake case")
-                df = df.withColumnsRenamed(RENAME_COLS_MAP)
-
-                logger.info(f"Writing data to target {TARGET_DB}.{TARGET_TABLE}")
-                df.writeTo(f"glue_catalog.{TARGET_DB}.{TARGET_TABLE}").tableProperty(
-                    "format-version", "2"
-                ).append()
+                load_df = load_df.withColumn("source_system", lit(SOURCE_SYSTEM))
+                load_df = load_df.withColumn(
+                    "source_table", lit(f"{SOURCE_DB}.{SOURCE_TABLE}")
+                )
+                load_df = load_df.withColumn("inserted_at", current_timestamp())
+                load_df = load_df.withColumn("job_name", lit(job_name))
+                load_df = load_df.withColumn("job_id", lit(job_id))
+                load_df = load_df.withColumn("job_run_id", lit(job_run_id))
+                load_df = load_df.withColumn("is_deleted", lit(False))
+
+                logger.info(f"Loading new rows into target {TARGET_DB}.{TARGET_TABLE}")
+                previous_snapshot = get_current_snapshot(spark, target_table)
+                batch_event_id = batch[-1].event_id
+                if batch_event_id > committed_event_id:
+                    load_df.writeTo(target_table).option(
+                        f"snapshot-property.{LAST_EVENT_PROPERTY}", str(batch_event_id)
+                    ).append()
+                current_snapshot = get_current_snapshot(spark, target_table)
+                filtered_num_rows = 0
+                if current_snapshot and current_snapshot != previous_snapshot:
+                    filtered_num_rows = int(
+                        current_snapshot["summary"].get("added-records", 0)
+                    )
+                logger.info(f"Number of rows loaded to target: {filtered_num_rows}")
 
                 # Mark records not in latest file as deleted
-                if event_id == latest_event_id:
-                    df.createOrReplaceTempView("latest_data")
-                    spark.sql(f"""
-                        UPDATE glue_catalog.{TARGET_DB}.{TARGET_TABLE}
-                        SET is_deleted = true
-                        WHERE row_hash NOT IN (SELECT row_hash FROM latest_data)
-                    """)
+                if any(event.event_id == latest_event_id for event in file_events):
+                    num_rows_deleted = mark_deleted_rows(
+                        spark,
+                        target_table,
+                        row_key,
+                        hashed_df.where(col(SOURCE_EVENT_COL) == latest_event_id),
+                    )
+                    logger.info(f"Number of rows marked as deleted: {num_rows_deleted}")
+                    total_rows_deleted += num_rows_deleted
+                hashed_df.unpersist()
 
-            logger.info(
-                f"Adding row to metadata.data_process_log for event #{event_id}, filename: {filename}"
-            )
-            insert_row_to_process_log(job_name, event_id, job_run_id, athena)
-            total_events_processed += 1
-            total_opl_events_processed += 1
-            total_rows_processed += filtered_num_rows
+                previous_file_event = file_events[-1]
+                total_opl_events_processed += len(file_events)
+                total_rows_processed += filtered_num_rows
+
+            # Rows are added in event order once the batch has committed, so
+            # a flush never moves the hwm past an event that is not processed
+            for event in batch:
+                logger.info(
+                    f"Adding row to metadata.data_process_log for event #{event.event_id}, filename: {event.s3_location or 'invalid'}"
+                )
+                process_log.add(event.event_id, job_run_id)
+            total_events_processed += len(batch)
+
+        process_log.flush()
 
         job_status = "SUCCESS"
-        message = f"\n\n{total_opl_events_processed} files processed and {total_rows_processed} rows added to {TARGET_DB}.{TARGET_TABLE}\n\n"
+        message = f"\n\n{total_opl_events_processed} files processed and {total_rows_processed} rows added to {TARGET_DB}.{TARGET_TABLE}, {total_rows_deleted} rows marked as deleted\n\n"
         return
 
     except Exception as e:
         logger.error(f"Error: {e}")
 
+        # Record the events that completed before the failure
+        if process_log is not None:
+            try:
+                process_log.flush()
+            except Exception as flush_error:
+                logger.error(f"Error flushing process log: {flush_error}")
+
         job_status = "FAILURE"
         message = f"\n\nJob failed:\n\n{traceback.format_exc()}"
         raise e
@@ -1,17 +1,35 @@
 import os
+import json
 import logging
+import tempfile
 import traceback
 from datetime import datetime, timezone
-from typing import Any
+from typing import Any, BinaryIO
 from zipfile import ZipFile
-from io import BytesIO
 
 import boto3
+import numpy as np
+from boto3.s3.transfer import TransferConfig
 
+from utils.common import AthenaQueryCache, check_conditional_writes
+from utils.profiling import ProfileStage
+from utils.schema import OPENPOWERLIFTING_HEADER
+from utils.validation import ValidationStage
 from utils.ingestion import (
-    get_file_from_url,
-    get_md5_from_buffer,
+    convert_csv_to_parquet,
+    open_csv_stream,
+    RowFilterStage,
+    RowHashStage,
+    get_row_hash_set,
+    put_row_hash_set,
+    spool_file_from_url,
+    get_url_validators,
+    put_url_validators,
+    is_source_unchanged,
     compare_ingestion_hash,
+    add_to_hash_index,
+    allocate_event_ids,
+    release_event_ids,
     insert_row_to_ingest_log,
 )
 
@@ -20,33 +38,194 @@ BUCKET = os.environ["BUCKET"]
 LAMBDA = os.environ["LAMBDA"]
 SNS_TOPIC_ARN = os.environ["SNS_TOPIC_ARN"]
 URL = os.environ["URL"]
+ZIP_PATH = os.path.join(tempfile.gettempdir(), "openpowerlifting-latest.zip")
+PARQUET_PATH = os.path.join(tempfile.gettempdir(), "openpowerlifting-latest.parquet")
+# The Glue workflow is started by a marker written once the event is in the
+# ingest log, so a run never starts before the event it was started for
+TRIGGER_PREFIX = "triggers/openpowerlifting"
+# Parquet copies go under their own prefix
+PARQUET_PREFIX = "parquet/openpowerlifting"
+WRITE_PARQUET = os.environ.get("WRITE_PARQUET", "true").lower() == "true"
+# Added and removed rows against the previous file
+DELTA_PREFIX = "deltas/openpowerlifting"
+ROW_HASH_SET = "openpowerlifting"
+# Rows failing the Record checks are dropped from the upload and kept here
+QUARANTINE_PATH = os.path.join(
+    tempfile.gettempdir(), "openpowerlifting-quarantine.jsonl"
+)
+QUARANTINE_PREFIX = "quarantine/openpowerlifting"
+VALIDATE_ROWS = os.environ.get("VALIDATE_ROWS", "true").lower() == "true"
+# Column profile of the uploaded rows, written next to the file it describes
+PROFILE_PREFIX = "profiles/openpowerlifting"
+
+# Multipart upload settings: memory held by the upload is bounded by
+# chunksize * max_concurrency regardless of the size of the CSV.
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=8,
+)
 
 athena = boto3.client("athena")
+glue = boto3.client("glue")
 s3 = boto3.client("s3")
 sns = boto3.client("sns")
 
+# Kept in /tmp so repeated lookups are served across warm invocations
+query_cache = AthenaQueryCache(
+    glue, cache_dir=os.path.join(tempfile.gettempdir(), "athena_query_cache")
+)
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def ingest_opl_zip(zip_file: BytesIO, bucket: str, s3_client) -> str:
+def write_deltas(
+    z: ZipFile,
+    csv_path: str,
+    prefix: str,
+    hashes: np.ndarray,
+    previous_hashes: np.ndarray,
+    previous_location: str,
+    bucket: str,
+    s3_client,
+) -> dict:
+    # Both hash sets are sorted and unique, so the diff is two linear merges
+    added = np.setdiff1d(hashes, previous_hashes, assume_unique=True)
+    removed = np.setdiff1d(previous_hashes, hashes, assume_unique=True)
+    deltas = {"rows_added": int(added.size), "rows_removed": int(removed.size)}
+
+    if added.size:
+        key = f"{prefix}.added.csv"
+        with z.open(csv_path, "r") as csv_file:
+            s3_client.upload_fileobj(
+                open_csv_stream(csv_file, [RowFilterStage(added)]),
+                bucket,
+                key,
+                Config=TRANSFER_CONFIG,
+            )
+        deltas["delta_added_s3_location"] = f"s3://{bucket}/{key}"
+
+    # Removed rows only exist in the previous file, which is streamed back
+    # from S3 and filtered the same way
+    if removed.size:
+        key = f"{prefix}.removed.csv"
+        previous_bucket, previous_key = previous_location.removeprefix("s3://").split(
+            "/", 1
+        )
+        response = s3_client.get_object(Bucket=previous_bucket, Key=previous_key)
+        s3_client.upload_fileobj(
+            open_csv_stream(response["Body"], [RowFilterStage(removed)]),
+            bucket,
+            key,
+            Config=TRANSFER_CONFIG,
+        )
+        deltas["delta_removed_s3_location"] = f"s3://{bucket}/{key}"
+
+    return deltas
+
+
+def ingest_opl_zip(
+    zip_file: str | BinaryIO,
+    bucket: str,
+    s3_client,
+    write_parquet: bool = False,
+    validate_rows: bool = False,
+    previous_hashes: np.ndarray | None = None,
+    previous_location: str | None = None,
+) -> tuple[dict, np.ndarray]:
     with ZipFile(zip_file) as z:
         csv_files = [name for name in z.namelist() if name.endswith(".csv")]
 
-    if not csv_files:
-        raise ValueError("No CSV files found in the ZIP archive.")
-    csv_path = csv_files[0]
+        if not csv_files:
+            raise ValueError("No CSV files found in the ZIP archive.")
+        csv_path = csv_files[0]
 
-    csv_fn = csv_path.split("/")[-1]
-    current_time = datetime.now()
-    prefix = f"openpowerlifting/year={current_time.strftime('%Y')}/month={current_time.strftime('%m')}/day={current_time.strftime('%d')}/"
-    key = prefix + csv_fn
+        csv_fn = csv_path.split("/")[-1]
+        current_time = datetime.now()
+        partition = f"year={current_time.strftime('%Y')}/month={current_time.strftime('%m')}/day={current_time.strftime('%d')}/"
+        key = "openpowerlifting/" + partition + csv_fn
+        stem = csv_fn.removesuffix(".csv")
 
-    with ZipFile(zip_file) as z:
+        # The member is decompressed as it is read, so only the in-flight
+        # multipart chunks are ever held in memory. Invalid rows are routed to
+        # quarantine and the rest are hashed on the way through for the delta
+        # against the previous file and profiled.
+        stages = []
+        validation = None
+        if validate_rows:
+            validation = ValidationStage(QUARANTINE_PATH)
+            stages.append(validation)
+        row_hashes = RowHashStage()
+        profile = ProfileStage()
+        stages.extend([row_hashes, profile])
         with z.open(csv_path, "r") as csv_file:
-            s3_client.upload_fileobj(csv_file, bucket, key)
+            s3_client.upload_fileobj(
+                open_csv_stream(csv_file, stages),
+                bucket,
+                key,
+                Config=TRANSFER_CONFIG,
+            )
+        hashes = row_hashes.get_hashes()
+        ingested = {"s3_location": f"s3://{bucket}/{key}"}
 
-    return f"s3://{bucket}/{key}"
+        if validation is not None:
+            logger.info(
+                f"Valid rows: {validation.valid_count}, invalid rows: {validation.invalid_count}"
+            )
+            ingested["valid_row_count"] = validation.valid_count
+            ingested["invalid_row_count"] = validation.invalid_count
+            if validation.invalid_count:
+                quarantine_key = f"{QUARANTINE_PREFIX}/{partition}{stem}.jsonl"
+                s3_client.upload_file(
+                    QUARANTINE_PATH, bucket, quarantine_key, Config=TRANSFER_CONFIG
+                )
+                ingested["quarantine_s3_location"] = f"s3://{bucket}/{quarantine_key}"
+
+        profile_key = f"{PROFILE_PREFIX}/{partition}{stem}.json"
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=profile_key,
+            Body=json.dumps(profile.to_dict()).encode("utf-8"),
+            ContentType="application/json",
+        )
+        ingested["profile_s3_location"] = f"s3://{bucket}/{profile_key}"
+
+        if write_parquet:
+            # Second streaming pass over the member, converted in bounded
+            # batches and spooled to /tmp before upload
+            parquet_key = f"{PARQUET_PREFIX}/{partition}{stem}.parquet"
+            with z.open(csv_path, "r") as csv_file:
+                # Quarantined rows are left out by keeping only uploaded rows
+                csv_source = csv_file
+                if validation is not None and validation.invalid_count:
+                    csv_source = open_csv_stream(csv_file, [RowFilterStage(hashes)])
+                num_rows = convert_csv_to_parquet(
+                    csv_source, PARQUET_PATH, OPENPOWERLIFTING_HEADER
+                )
+            s3_client.upload_file(
+                PARQUET_PATH, bucket, parquet_key, Config=TRANSFER_CONFIG
+            )
+            logger.info(f"Converted {num_rows} rows to Parquet")
+            ingested["parquet_s3_location"] = f"s3://{bucket}/{parquet_key}"
+
+        if previous_hashes is not None:
+            deltas = write_deltas(
+                z,
+                csv_path,
+                f"{DELTA_PREFIX}/{partition}{stem}",
+                hashes,
+                previous_hashes,
+                previous_location,
+                bucket,
+                s3_client,
+            )
+            logger.info(
+                f"Rows added: {deltas['rows_added']}, rows removed: {deltas['rows_removed']}"
+            )
+            ingested.update(deltas)
+
+    return ingested, hashes
 
 
 def lambda_handler(event: dict[str, Any], context: Any) -> dict[str, Any]:
@@ -62,22 +241,42 @@ def lambda_handler(event: dict[str, Any], context: Any) -> dict[str, Any]:
     logger.info(f"Lambda function {LAMBDA} started. URL: {URL}, Bucket: {BUCKET}")
 
     try:
-        zip_file = get_file_from_url(URL)
-        hash = get_md5_from_buffer(zip_file)
-        hash_exists = compare_ingestion_hash(hash, LAMBDA, athena)
+        check_conditional_writes(s3)
+        validators = get_url_validators(URL, s3, BUCKET)
+        if is_source_unchanged(URL, validators):
+            logger.info(f"Source unchanged since last download: {validators}")
+            lambda_status = "NO NEW DATA"
+            message = "No new data to ingest."
+            status = {"statusCode": 200, "message": message}
+            return status
+
+        hash, validators = spool_file_from_url(URL, ZIP_PATH)
+        hash_exists = compare_ingestion_hash(
+            hash, LAMBDA, athena, cache=query_cache, s3_client=s3, bucket=BUCKET
+        )
 
         logger.info(
             f"Zip file downloaded. MD5 hash: {hash} , Hash exists in data ingestion log: {hash_exists}"
         )
 
         if hash_exists:
+            put_url_validators(URL, validators, s3, BUCKET)
             lambda_status = "NO NEW DATA"
             message = "No new data to ingest."
             status = {"statusCode": 200, "message": message}
             return status
 
         logger.info("Ingesting file obtained from URL.")
-        s3_location = ingest_opl_zip(zip_file, BUCKET, s3)
+        previous_hashes, previous_location = get_row_hash_set(ROW_HASH_SET, s3, BUCKET)
+        ingested, row_hashes = ingest_opl_zip(
+            ZIP_PATH,
+            BUCKET,
+            s3,
+            write_parquet=WRITE_PARQUET,
+            validate_rows=VALIDATE_ROWS,
+            previous_hashes=previous_hashes,
+            previous_location=previous_location,
+        )
 
         payload = {
             "ingest_ts": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f"),
@@ -85,10 +284,29 @@ def lambda_handler(event: dict[str, Any], context: Any) -> dict[str, Any]:
             "event_type": "new_file",
             "source_system": "Openpowerlifting.org",
             "file_md5_hash": hash,
-            "s3_location": s3_location,
         }
+        payload.update(ingested)
         logger.info(f"File ingested, sending payload to Ingest Data Log: {payload}")
-        insert_row_to_ingest_log(payload, athena)
+        event_id = allocate_event_ids(s3, BUCKET, athena)
+        try:
+            insert_row_to_ingest_log(payload, athena, event_id=event_id)
+        finally:
+            # Consumers hold their hwm below the id until it is released,
+            # either with its row in the log or as a gap to skip
+            release_event_ids(event_id, s3, BUCKET)
+        add_to_hash_index(hash, LAMBDA, s3, BUCKET)
+        s3.put_object(
+            Bucket=BUCKET,
+            Key=f"{TRIGGER_PREFIX}/{event_id}.json",
+            Body=json.dumps(
+                {"event_id": event_id, "s3_location": payload["s3_location"]}
+            ),
+            ContentType="application/json",
+        )
+        # Only advanced once the event is logged, so a failed run is diffed
+        # against the same previous file when it is retried
+        put_row_hash_set(ROW_HASH_SET, row_hashes, payload["s3_location"], s3, BUCKET)
+        put_url_validators(URL, validators, s3, BUCKET)
 
         lambda_status = "SUCCESS"
         message = "File ingested successfully."
@@ -103,6 +321,10 @@ def lambda_handler(event: dict[str, Any], context: Any) -> dict[str, Any]:
         raise e
 
     finally:
+        for path in (ZIP_PATH, PARQUET_PATH, QUARANTINE_PATH):
+            if os.path.exists(path):
+                os.remove(path)
+
         logger.info(status)
         logger.info("Sending SNS notification")
         sns.publish(
@@ -1,9 +1,36 @@
+import io
 import json
+import random
+import time
 from io import BytesIO
-from hashlib import md5
+from hashlib import blake2b, md5
+from typing import BinaryIO
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
+from botocore.exceptions import ClientError
+from pyarrow import csv
 
-from utils.common import run_athena_query
+from utils.common import (
+    ALLOCATION_TIMEOUT_SECONDS,
+    SEQUENCE_PREFIX,
+    AthenaQueryCache,
+    get_json_object,
+    get_sequence_key,
+    put_json_object,
+    run_athena_query,
+)
+
+
+VALIDATOR_HEADERS = ("ETag", "Last-Modified", "Content-Length")
+VALIDATORS_PREFIX = "_ingest_state/http_validators"
+HASH_INDEX_PREFIX = "_ingest_state/hash_index"
+# Written once a producer's logged hashes are all in the index
+HASH_INDEX_MARKER = "_complete"
+ROW_HASHES_PREFIX = "_ingest_state/row_hashes"
+CSV_BLOCK_SIZE = 8 * 1024 * 1024
+PARQUET_ROW_GROUP_SIZE = 128 * 1024
 
 
 def get_file_from_url(url: str) -> BytesIO:
@@ -19,31 +46,485 @@ def get_md5_from_buffer(buffer: BytesIO) -> str:
     return md5(buffer.read()).hexdigest()
 
 
+def spool_file_from_url(
+    url: str, path: str, chunk_size: int = 8 * 1024 * 1024
+) -> tuple[str, dict]:
+    # Hash each chunk as it is written so the body is never held in memory
+    file_hash = md5()
+    with requests.get(url, stream=True, timeout=300) as response:
+        response.raise_for_status()
+        validators = get_response_validators(response)
+        with open(path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                file_hash.update(chunk)
+                f.write(chunk)
+    return file_hash.hexdigest(), validators
+
+
+def get_response_validators(response: requests.Response) -> dict:
+    return {
+        header: response.headers[header]
+        for header in VALIDATOR_HEADERS
+        if header in response.headers
+    }
+
+
+def convert_csv_to_parquet(
+    csv_file: str | BinaryIO,
+    parquet_path: str,
+    column_names: list[str],
+    block_size: int = CSV_BLOCK_SIZE,
+    row_group_size: int = PARQUET_ROW_GROUP_SIZE,
+) -> int:
+    # Every column is kept as a string and only empty fields become null, so
+    # rows read from the Parquet hash the same as rows read from the CSV.
+    # Memory is bounded by one row group plus one CSV block.
+    reader = csv.open_csv(
+        csv_file,
+        read_options=csv.ReadOptions(block_size=block_size),
+        convert_options=csv.ConvertOptions(
+            column_types={x: pa.string() for x in column_names},
+            null_values=[""],
+            strings_can_be_null=True,
+        ),
+    )
+    num_rows = 0
+    pending = []
+    pending_rows = 0
+    with pq.ParquetWriter(parquet_path, reader.schema, compression="snappy") as writer:
+        for batch in reader:
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            while pending_rows >= row_group_size:
+                table = pa.Table.from_batches(pending, schema=reader.schema)
+                writer.write_table(table.slice(0, row_group_size), row_group_size)
+                pending = table.slice(row_group_size).to_batches()
+                pending_rows -= row_group_size
+                num_rows += row_group_size
+        if pending_rows:
+            table = pa.Table.from_batches(pending, schema=reader.schema)
+            writer.write_table(table, row_group_size)
+            num_rows += pending_rows
+    return num_rows
+
+
+def hash_lines(lines: list[bytes]) -> np.ndarray:
+    # 8-byte digests, so a full dump's hash set fits in a few tens of MB
+    digests = b"".join(blake2b(line, digest_size=8).digest() for line in lines)
+    return np.frombuffer(digests, dtype=np.uint64)
+
+
+class CsvStage:
+    """
+    Step in a CsvLineStream. Gets the header once, then each batch of lines in
+    order, and returns the lines to pass on.
+    """
+
+    def start(self, header: bytes) -> None:
+        return
+
+    def process(self, lines: list[bytes]) -> list[bytes]:
+        return lines
+
+    def finish(self) -> None:
+        return
+
+
+class RowHashStage(CsvStage):
+    """
+    Collects the hash of every line that passes through.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def process(self, lines: list[bytes]) -> list[bytes]:
+        self.batches.append(hash_lines(lines))
+        return lines
+
+    def get_hashes(self) -> np.ndarray:
+        # Sorted and unique, the layout the delta set operations expect
+        if not self.batches:
+            return np.empty(0, dtype=np.uint64)
+        return np.unique(np.concatenate(self.batches))
+
+
+class RowFilterStage(CsvStage):
+    """
+    Keeps only the lines whose hash is in a sorted hash set.
+    """
+
+    def __init__(self, hashes: np.ndarray):
+        self.hashes = hashes
+        self.num_rows = 0
+
+    def process(self, lines: list[bytes]) -> list[bytes]:
+        mask = np.isin(hash_lines(lines), self.hashes)
+        lines = [line for line, keep in zip(lines, mask) if keep]
+        self.num_rows += len(lines)
+        return lines
+
+
+class CsvLineStream(io.RawIOBase):
+    """
+    Readable stream over a binary CSV that hands the header and each batch of
+    complete lines to a chain of stages as it is read, then yields the header
+    and whatever lines the stages kept. Only one batch is held in memory.
+    """
+
+    def __init__(
+        self, raw: BinaryIO, stages: list[CsvStage], chunk_size: int = CSV_BLOCK_SIZE
+    ):
+        self.raw = raw
+        self.stages = stages
+        self.chunk_size = chunk_size
+        self.header = None
+        self._remainder = b""
+        self._output = memoryview(b"")
+        self._offset = 0
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self._offset == len(self._output) and not self._eof:
+            self._read_batch()
+        size = min(len(buffer), len(self._output) - self._offset)
+        buffer[:size] = self._output[self._offset : self._offset + size]
+        self._offset += size
+        return size
+
+    def _read_batch(self) -> None:
+        chunk = self.raw.read(self.chunk_size)
+        if chunk:
+            data = self._remainder + chunk
+            cut = data.rfind(b"\n")
+            if cut == -1:
+                self._remainder = data
+                return
+            data, self._remainder = data[:cut], data[cut + 1 :]
+        else:
+            self._eof = True
+            data, self._remainder = self._remainder, b""
+
+        lines = [line for line in data.split(b"\n") if line]
+        output = []
+        if self.header is None and lines:
+            self.header = lines.pop(0)
+            output.append(self.header)
+            for stage in self.stages:
+                stage.start(self.header)
+        for stage in self.stages:
+            if not lines:
+                break
+            lines = stage.process(lines)
+        output.extend(lines)
+
+        if self._eof:
+            for stage in self.stages:
+                stage.finish()
+        self._output = memoryview(b"\n".join(output) + b"\n" if output else b"")
+        self._offset = 0
+        return
+
+
+def open_csv_stream(
+    raw: BinaryIO, stages: list[CsvStage], chunk_size: int = CSV_BLOCK_SIZE
+) -> io.BufferedReader:
+    # Buffered so read(n) returns full n-byte reads, which multipart uploads
+    # rely on for their part sizes
+    return io.BufferedReader(CsvLineStream(raw, stages, chunk_size), chunk_size)
+
+
+def get_url_validators(
+    url: str, s3_client, bucket: str, prefix: str = VALIDATORS_PREFIX
+) -> dict:
+    key = f"{prefix}/{md5(url.encode()).hexdigest()}.json"
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return {}
+    return json.loads(response["Body"].read())
+
+
+def put_url_validators(
+    url: str,
+    validators: dict,
+    s3_client,
+    bucket: str,
+    prefix: str = VALIDATORS_PREFIX,
+) -> None:
+    key = f"{prefix}/{md5(url.encode()).hexdigest()}.json"
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps({"url": url, **validators}),
+        ContentType="application/json",
+    )
+    return
+
+
+def is_source_unchanged(url: str, validators: dict) -> bool:
+    if not validators:
+        return False
+
+    headers = {}
+    if "ETag" in validators:
+        headers["If-None-Match"] = validators["ETag"]
+    if "Last-Modified" in validators:
+        headers["If-Modified-Since"] = validators["Last-Modified"]
+
+    # Any failure of the check falls back to downloading and comparing hashes,
+    # including a server that does not support HEAD
+    try:
+        response = requests.head(url, headers=headers, timeout=60, allow_redirects=True)
+    except requests.RequestException:
+        return False
+    if response.status_code == 304:
+        return True
+    if not response.ok:
+        return False
+
+    current = get_response_validators(response)
+    if "ETag" in validators and "ETag" in current:
+        return validators["ETag"] == current["ETag"]
+    if "Last-Modified" in validators and "Last-Modified" in current:
+        return all(
+            validators.get(header) == current.get(header)
+            for header in ("Last-Modified", "Content-Length")
+        )
+    return False
+
+
+def hash_index_contains(
+    hash: str,
+    event_producer: str,
+    s3_client,
+    bucket: str,
+    prefix: str = HASH_INDEX_PREFIX,
+) -> bool:
+    try:
+        s3_client.head_object(Bucket=bucket, Key=f"{prefix}/{event_producer}/{hash}")
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    return True
+
+
+def add_to_hash_index(
+    hash: str,
+    event_producer: str,
+    s3_client,
+    bucket: str,
+    prefix: str = HASH_INDEX_PREFIX,
+) -> None:
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=f"{prefix}/{event_producer}/{hash}",
+        Body=b"",
+    )
+    return
+
+
+def backfill_hash_index(
+    event_producer: str,
+    athena_client,
+    s3_client,
+    bucket: str,
+    log_table: str = "metadata.data_ingest_log",
+    prefix: str = HASH_INDEX_PREFIX,
+) -> set[str]:
+    # Indexes every hash the producer has logged, then writes the marker that
+    # makes a miss in the index authoritative. Returns the logged hashes.
+    query = f"""
+        select distinct file_md5_hash
+        from {log_table}
+        where file_md5_hash is not null
+        and event_producer = '{event_producer}'
+    """
+    rows = run_athena_query(query, athena_client, result_format="typed")["Rows"]
+    hashes = {row.file_md5_hash for row in rows}
+    for hash in hashes:
+        add_to_hash_index(hash, event_producer, s3_client, bucket, prefix)
+    add_to_hash_index(HASH_INDEX_MARKER, event_producer, s3_client, bucket, prefix)
+    return hashes
+
+
+def get_row_hash_set(
+    name: str, s3_client, bucket: str, prefix: str = ROW_HASHES_PREFIX
+) -> tuple[np.ndarray | None, str | None]:
+    # Row hashes of the last ingested file and where that file was written
+    key = f"{prefix}/{name}.npy"
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return None, None
+    hashes = np.load(BytesIO(response["Body"].read()), allow_pickle=False)
+    return hashes, response["Metadata"].get("s3-location")
+
+
+def put_row_hash_set(
+    name: str,
+    hashes: np.ndarray,
+    s3_location: str,
+    s3_client,
+    bucket: str,
+    prefix: str = ROW_HASHES_PREFIX,
+) -> None:
+    key = f"{prefix}/{name}.npy"
+    buffer = BytesIO()
+    np.save(buffer, hashes, allow_pickle=False)
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=buffer.getvalue(),
+        Metadata={"s3-location": s3_location},
+    )
+    return
+
+
 def compare_ingestion_hash(
     hash: str,
     lambda_function: str,
     athena_client,
     log_table: str = "metadata.data_ingest_log",
+    cache: AthenaQueryCache | None = None,
+    s3_client=None,
+    bucket: str | None = None,
 ) -> bool:
-    hash_exists = False
+    # The marker index answers with a HEAD or two. Once the backfill marker
+    # exists a miss is a new file, without it the log is read once to build
+    # the index. Hashes are indexed after their log insert, so a run that
+    # stops in between only ingests the same file again.
+    if s3_client is not None and bucket is not None:
+        if hash_index_contains(hash, lambda_function, s3_client, bucket):
+            return True
+        if hash_index_contains(HASH_INDEX_MARKER, lambda_function, s3_client, bucket):
+            return False
+        hashes = backfill_hash_index(
+            lambda_function, athena_client, s3_client, bucket, log_table
+        )
+        return hash in hashes
+
     query = f"""
         select count(*) > 0 as hash_exists 
         from {log_table}
         where file_md5_hash = '{hash}'
         and event_producer = '{lambda_function}'
     """
-    query_results = run_athena_query(query, athena_client)["Rows"][0][0]["VarCharValue"]
-    if query_results != "false":
-        hash_exists = True
+    result = run_athena_query(query, athena_client, result_format="typed", cache=cache)
+    return result["Rows"][0].hash_exists
+
+
+def allocate_event_ids(
+    s3_client,
+    bucket: str,
+    athena_client,
+    count: int = 1,
+    log_table: str = "metadata.data_ingest_log",
+    prefix: str = SEQUENCE_PREFIX,
+    max_attempts: int = 10,
+    timeout: int = ALLOCATION_TIMEOUT_SECONDS,
+) -> int:
+    # Reserves count consecutive event ids from a counter object updated with
+    # compare-and-swap, and returns the first one. The counter is seeded once
+    # from the log when it does not exist yet. The ids are recorded as pending
+    # in the same write, so consumers wait on them until release_event_ids,
+    # and entries older than the timeout are dropped.
+    key = get_sequence_key(log_table, prefix)
+    for attempt in range(max_attempts):
+        sequence, etag = get_json_object(s3_client, bucket, key)
+        now = time.time()
+        if sequence is None:
+            seed_sql = f"""
+                select coalesce(max(event_id),-1) + 1 as next_event_id
+                from {log_table}
+            """
+            result = run_athena_query(seed_sql, athena_client, result_format="typed")
+            next_event_id = result["Rows"][0].next_event_id
+            pending = {}
+        else:
+            next_event_id = sequence["next_event_id"]
+            pending = {
+                k: v
+                for k, v in sequence.get("pending", {}).items()
+                if now - v < timeout
+            }
+        for event_id in range(next_event_id, next_event_id + count):
+            pending[str(event_id)] = now
+
+        if put_json_object(
+            s3_client,
+            bucket,
+            key,
+            {"next_event_id": next_event_id + count, "pending": pending},
+            etag,
+        ):
+            return next_event_id
+
+        time.sleep(random.uniform(0, 0.05 * 2**attempt))
 
-    return hash_exists
+    raise RuntimeError(
+        f"Could not allocate event ids for {log_table} after {max_attempts} attempts."
+    )
+
+
+def release_event_ids(
+    event_id: int,
+    s3_client,
+    bucket: str,
+    count: int = 1,
+    log_table: str = "metadata.data_ingest_log",
+    prefix: str = SEQUENCE_PREFIX,
+    max_attempts: int = 10,
+) -> None:
+    # Clears ids from the pending set once their rows are inserted, or once
+    # the producer gives up on them, which leaves a gap consumers skip
+    key = get_sequence_key(log_table, prefix)
+    released = {str(x) for x in range(event_id, event_id + count)}
+    for attempt in range(max_attempts):
+        sequence, etag = get_json_object(s3_client, bucket, key)
+        pending = (sequence or {}).get("pending", {})
+        if not released & pending.keys():
+            return
+
+        pending = {k: v for k, v in pending.items() if k not in released}
+        if put_json_object(
+            s3_client, bucket, key, {**sequence, "pending": pending}, etag
+        ):
+            return
+
+        time.sleep(random.uniform(0, 0.05 * 2**attempt))
+
+    raise RuntimeError(
+        f"Could not release event ids for {log_table} after {max_attempts} attempts."
+    )
 
 
 def insert_row_to_ingest_log(
     payload: dict,
     athena_client,
     log_table: str = "metadata.data_ingest_log",
+    event_id: int | None = None,
 ) -> None:
+    if event_id is not None:
+        insert_sql = f"""
+            insert into {log_table} (event_id, ingest_ts, event_producer, event_type, source_system, file_md5_hash, payload)
+            values (
+                {event_id},
+                cast('{payload["ingest_ts"]}' as timestamp),
+                '{payload["event_producer"]}',
+                '{payload["event_type"]}',
+                '{payload["source_system"]}',
+                '{payload["file_md5_hash"]}',
+                '{json.dumps(payload)}'
+            )
+        """
+        run_athena_query(insert_sql, athena_client, False)
+        return
+
     insert_sql = f"""
         insert into {log_table} (event_id, ingest_ts, event_producer, event_type, source_system, file_md5_hash, payload)
         select 
@@ -0,0 +1,174 @@
+from collections import Counter
+from io import BytesIO
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv
+
+from utils.ingestion import CsvStage
+from utils.schema import OPENPOWERLIFTING_COLUMNS
+from utils.validation import parse_numbers
+
+
+HLL_PRECISION = 12
+TOP_K = 20
+TOP_K_COLUMNS = ("Federation", "Equipment", "Country")
+
+
+class HyperLogLog:
+    """
+    Distinct count estimate in 2^precision one-byte registers, 4 KB per column
+    at the default precision for a standard error of about 1.6%.
+    """
+
+    def __init__(self, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add_hashes(self, hashes: np.ndarray) -> None:
+        # Top bits pick the register, the rest give the rank of the first set
+        # bit. frexp finds the highest set bit and the shift check undoes its
+        # rounding for values above 2^53.
+        width = 64 - self.precision
+        index = (hashes >> np.uint64(width)).astype(np.intp)
+        rest = hashes & np.uint64((1 << width) - 1)
+        highest = np.frexp(rest.astype(np.float64))[1].astype(np.int64) - 1
+        rounded_up = (np.uint64(1) << highest.clip(0).astype(np.uint64)) > rest
+        highest = np.where(rounded_up, highest - 1, highest)
+        rank = np.clip(width - highest, 1, width + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+        return
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(int)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        # Linear counting is more accurate while many registers are empty
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+
+def hash_values(values: pa.Array) -> np.ndarray:
+    # Python's string hash is a 64-bit SipHash. It is salted per process, which
+    # is fine because the sketches are never merged across runs.
+    return np.array([hash(x) for x in values.to_pylist()], dtype=np.int64).view(
+        np.uint64
+    )
+
+
+def to_numbers(values: pa.ChunkedArray) -> pa.ChunkedArray:
+    # Empty and unparseable fields become null. Numbers are parsed as in
+    # validation, so the profile doesn't depend on the batch. inf and nan are
+    # valid but left out, they would swamp min, max and mean.
+    parsed, cleaned = parse_numbers(values)
+    numbers = pc.cast(pc.if_else(parsed, cleaned, None), pa.float64())
+    return pc.if_else(pc.is_finite(numbers), numbers, None)
+
+
+class ColumnProfile:
+    """
+    Running statistics for one column: null count, distinct estimate, min/max
+    and mean for numeric columns, min/max for dates and top-k counts for
+    categorical columns.
+    """
+
+    def __init__(self, name: str, type: str, top_k: bool):
+        self.name = name
+        self.type = type
+        self.null_count = 0
+        self.hll = HyperLogLog()
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.count = 0
+        self.counts = Counter() if top_k else None
+
+    def update(self, values: pa.ChunkedArray) -> None:
+        empty = pc.equal(values, "")
+        self.null_count += pc.sum(empty).as_py() or 0
+        present = pc.filter(values, pc.invert(empty))
+
+        # Only the batch's unique values are hashed
+        uniques = pc.unique(present)
+        self.hll.add_hashes(hash_values(uniques))
+
+        if self.counts is not None:
+            for row in pc.value_counts(present).to_pylist():
+                self.counts[row["values"]] += row["counts"]
+
+        if self.type == "double":
+            present = to_numbers(present)
+            self.sum += pc.sum(present).as_py() or 0.0
+            self.count += pc.count(present).as_py()
+        if self.type in ("double", "date"):
+            min_max = pc.min_max(present).as_py()
+            if min_max["min"] is not None and self.min is None:
+                self.min, self.max = min_max["min"], min_max["max"]
+            elif min_max["min"] is not None:
+                self.min = min(self.min, min_max["min"])
+                self.max = max(self.max, min_max["max"])
+        return
+
+    def to_dict(self) -> dict:
+        profile = {
+            "null_count": self.null_count,
+            "distinct_estimate": self.hll.estimate(),
+        }
+        if self.type in ("double", "date"):
+            profile["min"] = self.min
+            profile["max"] = self.max
+        if self.type == "double":
+            profile["mean"] = self.sum / self.count if self.count else None
+        if self.counts is not None:
+            profile["top_values"] = [
+                {"value": value, "count": count}
+                for value, count in self.counts.most_common(TOP_K)
+            ]
+        return profile
+
+
+class ProfileStage(CsvStage):
+    """
+    CsvLineStream stage that builds a column profile of every row passing
+    through, in the same pass as the upload.
+    """
+
+    def __init__(self, columns: list = OPENPOWERLIFTING_COLUMNS):
+        self.columns = {
+            x.source_name: ColumnProfile(
+                x.source_name, x.type, x.source_name in TOP_K_COLUMNS
+            )
+            for x in columns
+        }
+        self.header = None
+        self.row_count = 0
+
+    def start(self, header: bytes) -> None:
+        self.header = header
+        return
+
+    def process(self, lines: list[bytes]) -> list[bytes]:
+        column_names = self.header.decode("utf-8").rstrip("\r").split(",")
+        table = csv.read_csv(
+            BytesIO(self.header + b"\n" + b"\n".join(lines)),
+            read_options=csv.ReadOptions(use_threads=False),
+            parse_options=csv.ParseOptions(invalid_row_handler=lambda row: "skip"),
+            convert_options=csv.ConvertOptions(
+                column_types={x: pa.string() for x in column_names},
+                strings_can_be_null=False,
+            ),
+        )
+        self.row_count += table.num_rows
+        for name, profile in self.columns.items():
+            if name in table.column_names:
+                profile.update(table[name])
+        return lines
+
+    def to_dict(self) -> dict:
+        return {
+            "row_count": self.row_count,
+            "columns": {name: x.to_dict() for name, x in self.columns.items()},
+        }
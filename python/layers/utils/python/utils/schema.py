@@ -0,0 +1,100 @@
+from collections import namedtuple
+
+
+# Typed layout of the OpenPowerlifting CSV, following the Record model in
+# pydantic_test.py. Types are Spark SQL type names. Place and WeightClassKg stay
+# strings because they mix numbers with codes like "DQ" or "120+".
+SourceColumn = namedtuple("SourceColumn", ["source_name", "name", "type"])
+
+OPENPOWERLIFTING_COLUMNS = [
+    SourceColumn("Name", "name", "string"),
+    SourceColumn("Sex", "sex", "string"),
+    SourceColumn("Event", "event", "string"),
+    SourceColumn("Equipment", "equipment", "string"),
+    SourceColumn("Age", "age", "double"),
+    SourceColumn("AgeClass", "age_class", "string"),
+    SourceColumn("BirthYearClass", "birth_year_class", "string"),
+    SourceColumn("Division", "division", "string"),
+    SourceColumn("BodyweightKg", "bodyweight_kg", "double"),
+    SourceColumn("WeightClassKg", "weightclass_kg", "string"),
+    SourceColumn("Squat1Kg", "squat_1_kg", "double"),
+    SourceColumn("Squat2Kg", "squat_2_kg", "double"),
+    SourceColumn("Squat3Kg", "squat_3_kg", "double"),
+    SourceColumn("Squat4Kg", "squat_4_kg", "double"),
+    SourceColumn("Best3SquatKg", "best_3_squat_kg", "double"),
+    SourceColumn("Bench1Kg", "bench_1_kg", "double"),
+    SourceColumn("Bench2Kg", "bench_2_kg", "double"),
+    SourceColumn("Bench3Kg", "bench_3_kg", "double"),
+    SourceColumn("Bench4Kg", "bench_4_kg", "double"),
+    SourceColumn("Best3BenchKg", "best_3_bench_kg", "double"),
+    SourceColumn("Deadlift1Kg", "deadlift_1_kg", "double"),
+    SourceColumn("Deadlift2Kg", "deadlift_2_kg", "double"),
+    SourceColumn("Deadlift3Kg", "deadlift_3_kg", "double"),
+    SourceColumn("Deadlift4Kg", "deadlift_4_kg", "double"),
+    SourceColumn("Best3DeadliftKg", "best_3_deadlift_kg", "double"),
+    SourceColumn("TotalKg", "total_kg", "double"),
+    SourceColumn("Place", "place", "string"),
+    SourceColumn("Dots", "dots", "double"),
+    SourceColumn("Wilks", "wilks", "double"),
+    SourceColumn("Glossbrenner", "glossbrenner", "double"),
+    SourceColumn("Goodlift", "goodlift", "double"),
+    SourceColumn("Tested", "tested", "boolean"),
+    SourceColumn("Country", "country", "string"),
+    SourceColumn("State", "state", "string"),
+    SourceColumn("Federation", "federation", "string"),
+    SourceColumn("ParentFederation", "parent_federation", "string"),
+    SourceColumn("Date", "date", "date"),
+    SourceColumn("MeetCountry", "meet_country", "string"),
+    SourceColumn("MeetState", "meet_state", "string"),
+    SourceColumn("MeetTown", "meet_town", "string"),
+    SourceColumn("MeetName", "meet_name", "string"),
+    SourceColumn("Sanctioned", "sanctioned", "boolean"),
+]
+
+OPENPOWERLIFTING_HEADER = [x.source_name for x in OPENPOWERLIFTING_COLUMNS]
+
+# Record field constraints as plain data for utils.validation. Columns without
+# an entry accept any string. Nullable columns also accept an empty field.
+# Kinds: "literal" (one of values), "float", "non_negative_float",
+# "int_or_literal" (an integer or one of values) and "date" (YYYY-MM-DD, or a
+# datetime with a zero time). Values are parsed as leniently as Record parses
+# them, with two deliberate exceptions: dates written as unix timestamps and
+# integers that only parse once pydantic strips leading zeros, like "0-2" or
+# "0__8", are rejected.
+Constraint = namedtuple("Constraint", ["kind", "nullable", "values"])
+
+OPENPOWERLIFTING_CONSTRAINTS = {
+    "Sex": Constraint("literal", False, ("M", "F", "Mx")),
+    "Event": Constraint("literal", False, ("S", "B", "D", "SB", "SD", "BD", "SBD")),
+    "Equipment": Constraint(
+        "literal",
+        False,
+        ("Raw", "Straps", "Wraps", "Single-ply", "Multi-ply", "Unlimited"),
+    ),
+    "Age": Constraint("non_negative_float", True, ()),
+    "BodyweightKg": Constraint("float", True, ()),
+    "Squat1Kg": Constraint("float", True, ()),
+    "Squat2Kg": Constraint("float", True, ()),
+    "Squat3Kg": Constraint("float", True, ()),
+    "Squat4Kg": Constraint("float", True, ()),
+    "Best3SquatKg": Constraint("float", True, ()),
+    "Bench1Kg": Constraint("float", True, ()),
+    "Bench2Kg": Constraint("float", True, ()),
+    "Bench3Kg": Constraint("float", True, ()),
+    "Bench4Kg": Constraint("float", True, ()),
+    "Best3BenchKg": Constraint("float", True, ()),
+    "Deadlift1Kg": Constraint("float", True, ()),
+    "Deadlift2Kg": Constraint("float", True, ()),
+    "Deadlift3Kg": Constraint("float", True, ()),
+    "Deadlift4Kg": Constraint("float", True, ()),
+    "Best3DeadliftKg": Constraint("float", True, ()),
+    "TotalKg": Constraint("non_negative_float", True, ()),
+    "Place": Constraint("int_or_literal", False, ("DQ", "DD", "NS", "G")),
+    "Dots": Constraint("non_negative_float", True, ()),
+    "Wilks": Constraint("non_negative_float", True, ()),
+    "Glossbrenner": Constraint("non_negative_float", True, ()),
+    "Goodlift": Constraint("non_negative_float", True, ()),
+    "Tested": Constraint("literal", True, ("Yes", "No")),
+    "Date": Constraint("date", False, ()),
+    "Sanctioned": Constraint("literal", False, ("Yes", "No")),
+}
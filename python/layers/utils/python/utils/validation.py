@@ -0,0 +1,422 @@
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from typing import BinaryIO, Iterator
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv
+
+from utils.ingestion import CsvStage
+from utils.schema import OPENPOWERLIFTING_CONSTRAINTS, OPENPOWERLIFTING_HEADER
+
+
+# Patterns follow pydantic's lax string parsing. Numbers are matched after
+# trimming WHITESPACE and dropping underscores, integers may carry a zero
+# fraction and dates may be datetimes with a zero time.
+FLOAT_PATTERN = r"^[+-]?((\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?|(?i:inf|infinity|nan))$"
+INT_PATTERN = r"^[+-]?\d+(_\d+)*(\.0+)?$"
+UNDERSCORE_PATTERN = r"^_|_$|__"
+PLAIN_DATE_PATTERN = r"^\d{4}-\d{2}-\d{2}$"
+DATE_PATTERN = (
+    r"^(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})"
+    r"(?:[Tt_ ](?P<hour>\d{2}):(?P<minute>\d{2})"
+    r"(?::(?P<second>\d{2})(?P<fraction>[.,]\d+)?)?"
+    r"(?:[Zz]|[+-](?P<tz_hour>\d{2}):?(?P<tz_minute>\d{2}))?)?$"
+)
+WHITESPACE = "\t\n\v\f\r \x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000"
+DATE_FIELDS = (
+    "year",
+    "month",
+    "day",
+    "hour",
+    "minute",
+    "second",
+    "tz_hour",
+    "tz_minute",
+)
+DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+VALIDATION_BLOCK_SIZE = 16 * 1024 * 1024
+
+FLOAT_PARSING_ERROR = {
+    "type": "float_parsing",
+    "msg": "Input should be a valid number, unable to parse string as a number",
+}
+NON_NEGATIVE_ERROR = {
+    "type": "greater_than_equal",
+    "msg": "Input should be greater than or equal to 0",
+}
+INT_PARSING_ERROR = {
+    "type": "int_parsing",
+    "msg": "Input should be a valid integer, unable to parse string as an integer",
+}
+INT_TYPE_ERROR = {
+    "type": "int_type",
+    "msg": "Input should be a valid integer",
+}
+DATE_PARSING_ERROR = {
+    "type": "date_parsing",
+    "msg": "Input should be a valid date in the format YYYY-MM-DD, year 0 is out of range",
+}
+DATE_FROM_DATETIME_PARSING_ERROR = {
+    "type": "date_from_datetime_parsing",
+    "msg": "Input should be a valid date or datetime",
+}
+DATE_FROM_DATETIME_INEXACT_ERROR = {
+    "type": "date_from_datetime_inexact",
+    "msg": "Datetimes provided to dates should have zero time - e.g. be exact dates",
+}
+
+
+def get_literal_error(values: tuple) -> dict:
+    quoted = [f"'{x}'" for x in values]
+    expected = " or ".join([", ".join(quoted[:-1]), quoted[-1]])
+    return {"type": "literal_error", "msg": f"Input should be {expected}"}
+
+
+def get_error(error: dict, loc: tuple) -> dict:
+    return {"type": error["type"], "loc": loc, "msg": error["msg"]}
+
+
+def parse_numbers(values: pa.ChunkedArray) -> tuple:
+    # Returns (parsed mask, cleaned strings). Like pydantic, underscores are
+    # only dropped when they sit between other characters, and a number with
+    # underscores is not trimmed. Cleaning leaves matching and empty values
+    # as they are, so it is skipped when there is nothing else.
+    parsed = pc.match_substring_regex(values, FLOAT_PATTERN)
+    if pc.all(pc.or_(parsed, pc.equal(values, ""))).as_py():
+        return parsed, values
+    cleaned = pc.if_else(
+        pc.match_substring(values, "_"),
+        pc.replace_substring(values, "_", ""),
+        pc.utf8_trim(values, WHITESPACE),
+    )
+    parsed = pc.and_not(
+        pc.match_substring_regex(cleaned, FLOAT_PATTERN),
+        pc.match_substring_regex(values, UNDERSCORE_PATTERN),
+    )
+    return parsed, cleaned
+
+
+def get_date_fields(values: pa.ChunkedArray) -> dict:
+    # Integer fields of DATE_PATTERN, 0 where a row or an optional part
+    # doesn't match. Plain dates are sliced, which gives the same fields
+    # without a regex extract.
+    if pc.all(pc.match_substring_regex(values, PLAIN_DATE_PATTERN)).as_py():
+        ones = np.ones(len(values), dtype=bool)
+        fields = {name: np.zeros(len(values), dtype=np.int64) for name in DATE_FIELDS}
+        fields |= {"shaped": ones, "zero_fraction": ones}
+        for name, start, stop in (("year", 0, 4), ("month", 5, 7), ("day", 8, 10)):
+            field = pc.utf8_slice_codeunits(values, start, stop)
+            fields[name] = pc.cast(field, pa.int64()).to_numpy()
+        return fields
+
+    parts = pc.extract_regex(values, DATE_PATTERN)
+    fields = {"shaped": pc.is_valid(parts).to_numpy()}
+    for name in DATE_FIELDS:
+        field = pc.fill_null(pc.struct_field(parts, name), "")
+        field = pc.if_else(pc.equal(field, ""), "0", field)
+        fields[name] = pc.cast(field, pa.int64()).to_numpy()
+    fraction = pc.fill_null(pc.struct_field(parts, "fraction"), "")
+    fields["zero_fraction"] = pc.match_substring_regex(
+        fraction, r"^([.,]0+)?$"
+    ).to_numpy()
+    return fields
+
+
+def check_column(name: str, values: pa.ChunkedArray, constraint) -> list:
+    # Returns (invalid mask, errors) pairs, one per failed check. Each check is
+    # a single vectorized kernel over the whole column.
+    checks = []
+    if constraint.kind == "literal":
+        ok = pc.is_in(values, value_set=pa.array(constraint.values))
+        checks.append((ok, [get_error(get_literal_error(constraint.values), (name,))]))
+    elif constraint.kind in ("float", "non_negative_float"):
+        # The patterns are the only authority, so results never depend on
+        # what else is in the batch
+        parsed, cleaned = parse_numbers(values)
+        checks.append((parsed, [get_error(FLOAT_PARSING_ERROR, (name,))]))
+        if constraint.kind == "non_negative_float":
+            numbers = pc.cast(pc.if_else(parsed, cleaned, "0"), pa.float64())
+            ok = pc.greater_equal(numbers, 0)
+            checks.append((ok, [get_error(NON_NEGATIVE_ERROR, (name,))]))
+    elif constraint.kind == "int_or_literal":
+        # Record turns an empty field into None, which fails the int check on
+        # type rather than parsing
+        empty = pc.equal(values, "")
+        is_literal = pc.is_in(values, value_set=pa.array(constraint.values))
+        trimmed = pc.utf8_trim(values, WHITESPACE)
+        is_int = pc.and_not(
+            pc.match_substring_regex(trimmed, INT_PATTERN),
+            pc.match_substring_regex(trimmed, UNDERSCORE_PATTERN),
+        )
+        literal_loc = "literal[" + ",".join(f"'{x}'" for x in constraint.values) + "]"
+        literal_error = get_error(
+            get_literal_error(constraint.values), (name, literal_loc)
+        )
+        ok = pc.or_(pc.or_(is_int, is_literal), empty)
+        errors = [get_error(INT_PARSING_ERROR, (name, "int")), literal_error]
+        checks.append((ok, errors))
+        if not constraint.nullable:
+            errors = [get_error(INT_TYPE_ERROR, (name, "int")), literal_error]
+            checks.append((pc.invert(empty), errors))
+    elif constraint.kind == "date":
+        # Calendar and clock ranges are checked on the matched fields. A
+        # valid datetime fails on a non-zero time first, then on year 0.
+        fields = get_date_fields(values)
+        year, month, day = fields["year"], fields["month"], fields["day"]
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        month_days = DAYS_IN_MONTH[month.clip(0, 12)] + ((month == 2) & leap)
+        valid = (
+            fields["shaped"]
+            & (month >= 1)
+            & (month <= 12)
+            & (day >= 1)
+            & (day <= month_days)
+            & (fields["hour"] < 24)
+            & (fields["minute"] < 60)
+            & (fields["second"] < 60)
+            & (fields["tz_hour"] < 24)
+            & (fields["tz_minute"] < 60)
+        )
+        zero_time = (
+            (fields["hour"] == 0)
+            & (fields["minute"] == 0)
+            & (fields["second"] == 0)
+            & fields["zero_fraction"]
+        )
+        inexact = valid & ~zero_time
+        year_zero = valid & zero_time & (year == 0)
+        checks.append(
+            (
+                pa.chunked_array([valid]),
+                [get_error(DATE_FROM_DATETIME_PARSING_ERROR, (name,))],
+            )
+        )
+        checks.append(
+            (pa.chunked_array([~year_zero]), [get_error(DATE_PARSING_ERROR, (name,))])
+        )
+        checks.append(
+            (
+                pa.chunked_array([~inexact]),
+                [get_error(DATE_FROM_DATETIME_INEXACT_ERROR, (name,))],
+            )
+        )
+    else:
+        raise ValueError(f"Unknown constraint kind: {constraint.kind}")
+
+    empty = pc.equal(values, "")
+    results = []
+    for ok, errors in checks:
+        if constraint.nullable:
+            ok = pc.or_(ok, empty)
+        invalid = pc.invert(ok).to_numpy()
+        if invalid.any():
+            results.append((invalid, errors))
+    return results
+
+
+def validate_csv_block(
+    header: bytes,
+    block: bytes,
+    first_line_number: int,
+    constraints: dict = OPENPOWERLIFTING_CONSTRAINTS,
+) -> tuple[np.ndarray, list[dict]]:
+    # Validates a newline-aligned block of rows. Returns a validity mask with
+    # one entry per line and the invalid rows in pydantic's
+    # {"line_number", "errors": [{"type", "loc", "msg", "input"}]} shape.
+    # Assumes one row per line, which holds for the OpenPowerlifting CSV.
+    column_names = header.decode("utf-8").rstrip("\r").split(",")
+    parse_errors = {}
+
+    def on_invalid_row(row):
+        parse_errors[row.number] = row
+        return "skip"
+
+    table = csv.read_csv(
+        BytesIO(header + b"\n" + block),
+        read_options=csv.ReadOptions(use_threads=False),
+        parse_options=csv.ParseOptions(
+            invalid_row_handler=on_invalid_row, ignore_empty_lines=False
+        ),
+        convert_options=csv.ConvertOptions(
+            column_types={x: pa.string() for x in column_names},
+            strings_can_be_null=False,
+        ),
+    )
+
+    # Row numbers reported by the reader count the header as row 1
+    num_lines = table.num_rows + len(parse_errors)
+    skipped = np.array(sorted(parse_errors), dtype=np.int64) - 2
+    kept = np.setdiff1d(np.arange(num_lines), skipped, assume_unique=True)
+    valid = np.ones(num_lines, dtype=bool)
+    valid[skipped] = False
+
+    errors_by_line = {}
+    for position in skipped:
+        row = parse_errors[position + 2]
+        errors_by_line[position] = [
+            {
+                "type": "csv_parsing",
+                "loc": (),
+                "msg": f"Expected {row.expected_columns} columns, got {row.actual_columns}",
+                "input": row.text,
+            }
+        ]
+
+    for name, constraint in constraints.items():
+        if name not in table.column_names:
+            continue
+        values = table[name]
+        for invalid, errors in check_column(name, values, constraint):
+            for index in np.flatnonzero(invalid):
+                value = values[int(index)].as_py()
+                errors_by_line.setdefault(kept[index], []).extend(
+                    {**error, "input": value} for error in errors
+                )
+
+    invalid_rows = []
+    for position in sorted(errors_by_line):
+        valid[position] = False
+        invalid_rows.append(
+            {
+                "line_number": first_line_number + int(position),
+                "errors": errors_by_line[position],
+            }
+        )
+    return valid, invalid_rows
+
+
+def iter_csv_blocks(
+    csv_file: BinaryIO, block_size: int = VALIDATION_BLOCK_SIZE
+) -> Iterator[tuple[bytes, int]]:
+    # Newline-aligned blocks after the header and the line number of the first
+    # line in each block
+    line_number = 2
+    remainder = b""
+    while True:
+        chunk = csv_file.read(block_size)
+        if not chunk:
+            break
+        data = remainder + chunk
+        cut = data.rfind(b"\n") + 1
+        if not cut:
+            remainder = data
+            continue
+        block, remainder = data[:cut], data[cut:]
+        yield block, line_number
+        line_number += block.count(b"\n")
+    if remainder:
+        yield remainder, line_number
+
+
+def validate_csv_file(
+    path: str,
+    expected_header: list[str] = OPENPOWERLIFTING_HEADER,
+    max_workers: int | None = None,
+    block_size: int = VALIDATION_BLOCK_SIZE,
+) -> tuple[int, int, list[dict]]:
+    # Fans blocks out across a process pool, with at most two blocks per
+    # worker in flight so memory stays bounded
+    max_workers = max_workers or os.cpu_count() or 1
+    valid_count = 0
+    invalid_rows = []
+
+    with open(path, "rb") as f, ProcessPoolExecutor(max_workers) as pool:
+        header = f.readline().rstrip(b"\r\n")
+        found_header = header.decode("utf-8").split(",")
+        if found_header != expected_header:
+            raise ValueError(
+                f"Header mismatch. \nExpected: {expected_header} \nFound: {found_header}"
+            )
+
+        pending = deque()
+        for block, first_line_number in iter_csv_blocks(f, block_size):
+            pending.append(
+                pool.submit(validate_csv_block, header, block, first_line_number)
+            )
+            while len(pending) >= 2 * max_workers:
+                valid, rows = pending.popleft().result()
+                valid_count += int(valid.sum())
+                invalid_rows.extend(rows)
+        while pending:
+            valid, rows = pending.popleft().result()
+            valid_count += int(valid.sum())
+            invalid_rows.extend(rows)
+
+    return valid_count, len(invalid_rows), invalid_rows
+
+
+class ValidationStage(CsvStage):
+    """
+    CsvLineStream stage that passes on valid lines and writes invalid ones,
+    with their errors, to a JSON Lines quarantine file. The file is only
+    created once there is an invalid row. Each batch is split across a thread
+    pool, the pyarrow kernels release the GIL.
+    """
+
+    def __init__(
+        self,
+        quarantine_path: str,
+        constraints: dict = OPENPOWERLIFTING_CONSTRAINTS,
+        max_workers: int | None = None,
+        expected_header: list[str] = OPENPOWERLIFTING_HEADER,
+    ):
+        self.quarantine_path = quarantine_path
+        self.constraints = constraints
+        self.expected_header = expected_header
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.header = None
+        self.valid_count = 0
+        self.invalid_count = 0
+        self._line_number = 2
+        self._quarantine = None
+        self._pool = ThreadPoolExecutor(self.max_workers)
+
+    def start(self, header: bytes) -> None:
+        found_header = header.decode("utf-8").rstrip("\r").split(",")
+        if found_header != self.expected_header:
+            raise ValueError(
+                f"Header mismatch. \nExpected: {self.expected_header} \nFound: {found_header}"
+            )
+        self.header = header
+        return
+
+    def process(self, lines: list[bytes]) -> list[bytes]:
+        first_line_number = self._line_number
+        size = -(-len(lines) // self.max_workers)
+        futures = [
+            self._pool.submit(
+                validate_csv_block,
+                self.header,
+                b"\n".join(lines[start : start + size]),
+                first_line_number + start,
+                self.constraints,
+            )
+            for start in range(0, len(lines), size)
+        ]
+        results = [x.result() for x in futures]
+        valid = np.concatenate([x[0] for x in results])
+        invalid_rows = [row for x in results for row in x[1]]
+        self._line_number += len(lines)
+        self.valid_count += int(valid.sum())
+        self.invalid_count += len(invalid_rows)
+        if not invalid_rows:
+            return lines
+
+        if self._quarantine is None:
+            self._quarantine = open(self.quarantine_path, "w", encoding="utf-8")
+        for row in invalid_rows:
+            line = lines[row["line_number"] - first_line_number]
+            row["line"] = line.rstrip(b"\r").decode("utf-8", "replace")
+            self._quarantine.write(json.dumps(row) + "\n")
+        return [line for line, keep in zip(lines, valid) if keep]
+
+    def finish(self) -> None:
+        self._pool.shutdown()
+        if self._quarantine is not None:
+            self._quarantine.close()
+        return
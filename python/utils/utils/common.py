@@ -1,76 +1,607 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
 import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+
 import boto3
+import botocore
+import pyarrow as pa
+from botocore.exceptions import ClientError
+from pyarrow import csv
 
 
-def run_athena_query(
+# batch_get_query_execution accepts at most 50 ids per call
+BATCH_GET_LIMIT = 50
+
+ATHENA_ARROW_TYPES = {
+    "boolean": pa.bool_(),
+    "tinyint": pa.int8(),
+    "smallint": pa.int16(),
+    "integer": pa.int32(),
+    "bigint": pa.int64(),
+    "float": pa.float32(),
+    "real": pa.float32(),
+    "double": pa.float64(),
+    "date": pa.date32(),
+    "timestamp": pa.timestamp("ms"),
+}
+
+ATHENA_PYTHON_TYPES = {
+    "boolean": lambda x: x == "true",
+    "tinyint": int,
+    "smallint": int,
+    "integer": int,
+    "bigint": int,
+    "float": float,
+    "real": float,
+    "double": float,
+    "decimal": Decimal,
+    "date": date.fromisoformat,
+    "timestamp": datetime.fromisoformat,
+}
+
+RESULT_FORMATS = ("rows", "typed", "arrow")
+
+# Event id counters, and the ids they have handed out that are not resolved
+# yet. An id stays pending until its producer inserts or abandons it, or for
+# at most ALLOCATION_TIMEOUT_SECONDS if the producer dies first.
+SEQUENCE_PREFIX = "_ingest_state/sequences"
+ALLOCATION_TIMEOUT_SECONDS = 900
+
+TABLE_REFERENCE_PATTERN = re.compile(
+    r"\b(?:from|join)\s+(?:\"?(\w+)\"?\.)?\"?(\w+)\"?", re.IGNORECASE
+)
+
+
+class AthenaQueryExecutor:
+    """
+    Submits Athena queries without waiting on them and polls every pending
+    query together with batch_get_query_execution. The poll interval starts
+    small and backs off exponentially with jitter while nothing completes.
+    Each submit returns a concurrent.futures.Future resolving to the same
+    dict as run_athena_query. Results are fetched on a small worker pool, so
+    a large result never holds up polling for the other queries.
+    """
+
+    def __init__(
+        self,
+        athena_client=None,
+        s3_client=None,
+        database: str = "metadata",
+        workgroup: str = "primary",
+        min_poll_interval: float = 0.1,
+        max_poll_interval: float = 1.0,
+        backoff_factor: float = 2.0,
+        result_workers: int = 4,
+    ):
+        self.athena_client = athena_client or boto3.client("athena")
+        self.s3_client = s3_client
+        self.database = database
+        self.workgroup = workgroup
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff_factor = backoff_factor
+        self.result_workers = result_workers
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._poller = None
+        self._result_pool = None
+        self._fetching = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wait()
+
+    def submit(
+        self,
+        query: str,
+        return_result: bool = True,
+        page_size: int = 1000,
+        result_format: str = "rows",
+        result_reuse_max_age: int | None = None,
+    ) -> Future:
+        if result_format not in RESULT_FORMATS:
+            raise ValueError(f"Unknown result format: {result_format}")
+
+        start_args = {
+            "QueryString": query,
+            "QueryExecutionContext": {"Database": self.database},
+            "WorkGroup": self.workgroup,
+        }
+        if result_reuse_max_age:
+            start_args["ResultReuseConfiguration"] = {
+                "ResultReuseByAgeConfiguration": {
+                    "Enabled": True,
+                    "MaxAgeInMinutes": result_reuse_max_age,
+                }
+            }
+        response = self.athena_client.start_query_execution(**start_args)
+        execution_id = response["QueryExecutionId"]
+
+        future = Future()
+        future.execution_id = execution_id
+        with self._lock:
+            self._pending[execution_id] = (
+                future,
+                return_result,
+                page_size,
+                result_format,
+            )
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(target=self._poll, daemon=True)
+                self._poller.start()
+        self._wakeup.set()
+        return future
+
+    def submit_all(self, queries: list[str], **kwargs) -> list[Future]:
+        return [self.submit(query, **kwargs) for query in queries]
+
+    def wait(self) -> None:
+        with self._lock:
+            futures = [pending[0] for pending in self._pending.values()]
+            futures.extend(self._fetching)
+        for future in futures:
+            future.exception()
+
+    def _poll(self) -> None:
+        interval = self.min_poll_interval
+        while True:
+            with self._lock:
+                execution_ids = list(self._pending)
+                if not execution_ids:
+                    self._poller = None
+                    return
+
+            completed = 0
+            for i in range(0, len(execution_ids), BATCH_GET_LIMIT):
+                batch = execution_ids[i : i + BATCH_GET_LIMIT]
+                try:
+                    response = self.athena_client.batch_get_query_execution(
+                        QueryExecutionIds=batch
+                    )
+                except Exception as e:
+                    self._fail(batch, e)
+                    completed += len(batch)
+                    continue
+
+                for execution in response["QueryExecutions"]:
+                    if self._complete(execution):
+                        completed += 1
+                for unprocessed in response.get("UnprocessedQueryExecutionIds", []):
+                    self._fail(
+                        [unprocessed["QueryExecutionId"]],
+                        RuntimeError(
+                            f"Athena query {unprocessed['QueryExecutionId']} could not be polled: {unprocessed.get('ErrorMessage')}"
+                        ),
+                    )
+                    completed += 1
+
+            # Reset the backoff whenever something finished or a new query
+            # was submitted, otherwise back off with full jitter.
+            if completed or self._wakeup.is_set():
+                interval = self.min_poll_interval
+            else:
+                interval = min(interval * self.backoff_factor, self.max_poll_interval)
+            self._wakeup.clear()
+            time.sleep(random.uniform(interval / 2, interval))
+
+    def _complete(self, execution: dict) -> bool:
+        execution_id = execution["QueryExecutionId"]
+        status = execution["Status"]["State"]
+        if status not in ("SUCCEEDED", "FAILED", "CANCELLED"):
+            return False
+
+        with self._lock:
+            future, return_result, page_size, result_format = self._pending.pop(
+                execution_id
+            )
+
+        if status in ("FAILED", "CANCELLED"):
+            reason = execution["Status"].get("StateChangeReason", "Unknown error")
+            future.set_exception(
+                RuntimeError(f"Athena query {status.lower()}: {reason}")
+            )
+            return True
+
+        if not return_result:
+            future.set_result({"Status": status})
+            return True
+
+        with self._lock:
+            if self._result_pool is None:
+                self._result_pool = ThreadPoolExecutor(
+                    self.result_workers, thread_name_prefix="athena-results"
+                )
+            self._fetching.add(future)
+        self._result_pool.submit(
+            self._fetch_results, future, execution, page_size, result_format
+        )
+        return True
+
+    def _fetch_results(
+        self, future: Future, execution: dict, page_size: int, result_format: str
+    ) -> None:
+        status = execution["Status"]["State"]
+        try:
+            if result_format == "arrow":
+                if self.s3_client is None:
+                    self.s3_client = boto3.client("s3")
+                result = read_athena_query_results_from_s3(
+                    execution, self.athena_client, self.s3_client
+                )
+            else:
+                result = get_athena_query_results(
+                    execution["QueryExecutionId"],
+                    self.athena_client,
+                    page_size,
+                    typed=result_format == "typed",
+                )
+            future.set_result({"Status": status, **result})
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._fetching.discard(future)
+        return
+
+    def _fail(self, execution_ids: list[str], error: Exception) -> None:
+        with self._lock:
+            futures = [self._pending.pop(x)[0] for x in execution_ids]
+        for future in futures:
+            future.set_exception(error)
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_athena_executor(
+    athena_client=None, max_poll_interval: float = 1.0
+) -> AthenaQueryExecutor:
+    # One shared executor per client, so concurrent callers are polled together
+    key = (id(athena_client) if athena_client else None, max_poll_interval)
+    with _executors_lock:
+        executor = _executors.get(key)
+        if executor is None or (
+            athena_client is not None and executor.athena_client is not athena_client
+        ):
+            executor = AthenaQueryExecutor(
+                athena_client, max_poll_interval=max_poll_interval
+            )
+            _executors[key] = executor
+    return executor
+
+
+def get_row_decoder(column_info: list[dict]):
+    # Rows become namedtuples (no per-row __dict__) of values parsed by their
+    # Athena type. Types without a parser stay str, missing values are None.
+    row_type = namedtuple("Row", [x["Name"] for x in column_info], rename=True)
+    parsers = [ATHENA_PYTHON_TYPES.get(x["Type"], str) for x in column_info]
+
+    def decode(data: list[dict]) -> tuple:
+        return row_type._make(
+            parse(cell["VarCharValue"]) if "VarCharValue" in cell else None
+            for parse, cell in zip(parsers, data)
+        )
+
+    return decode
+
+
+def iter_athena_query_pages(execution_id: str, athena_client, page_size: int = 1000):
+    # Yields (ColumnInfo, rows) for each page of results, without the header row
+    page_args = {
+        "QueryExecutionId": execution_id,
+        "MaxResults": page_size,
+    }
+    is_first_page = True
+
+    while True:
+        response = athena_client.get_query_results(**page_args)
+
+        column_info = response["ResultSet"]["ResultSetMetadata"]["ColumnInfo"]
+        rows = [x["Data"] for x in response["ResultSet"]["Rows"]]
+        if is_first_page:
+            rows = rows[1:]
+            is_first_page = False
+        yield column_info, rows
+
+        next_token = response.get("NextToken")
+        if not next_token:
+            break
+        else:
+            page_args["NextToken"] = next_token
+
+
+def get_athena_query_results(
+    execution_id: str, athena_client, page_size: int = 1000, typed: bool = False
+) -> dict:
+    all_rows = []
+    column_info = None
+    decode = None
+
+    for column_info, rows in iter_athena_query_pages(
+        execution_id, athena_client, page_size
+    ):
+        if typed and decode is None:
+            decode = get_row_decoder(column_info)
+
+        if decode:
+            all_rows.extend([decode(x) for x in rows])
+        else:
+            all_rows.extend(rows)
+
+    return {
+        "ColumnInfo": column_info,
+        "Rows": all_rows,
+    }
+
+
+def iter_athena_query_rows(
     query: str,
     athena_client=None,
-    return_result: bool = True,
     poll_interval: float = 1.0,
     page_size: int = 1000,
+):
+    # Runs the query, then yields typed rows one page at a time so large
+    # results are never held in memory all at once
+    executor = get_athena_executor(athena_client, max_poll_interval=poll_interval)
+    future = executor.submit(query, return_result=False)
+    future.result()
+
+    decode = None
+    for column_info, rows in iter_athena_query_pages(
+        future.execution_id, executor.athena_client, page_size
+    ):
+        if decode is None:
+            decode = get_row_decoder(column_info)
+        for row in rows:
+            yield decode(row)
+
+
+def get_arrow_type(column: dict) -> pa.DataType:
+    if column["Type"] == "decimal":
+        return pa.decimal128(column["Precision"], column["Scale"])
+    return ATHENA_ARROW_TYPES.get(column["Type"], pa.string())
+
+
+def read_athena_query_results_from_s3(
+    execution: dict, athena_client, s3_client, block_size: int = 16 * 1024 * 1024
 ) -> dict:
-    if athena_client is None:
-        athena_client = boto3.client("athena")
-
-    # Initiate query
-    start_args = {
-        "QueryString": query,
-        "QueryExecutionContext": {"Database": "metadata"},
-        "WorkGroup": "primary",
+    # Reads the CSV Athena wrote to the output location in one streamed GET
+    # instead of paging GetQueryResults. Only the column metadata comes from
+    # the API. Unquoted empty fields are nulls, quoted ones are empty strings.
+    execution_id = execution["QueryExecutionId"]
+    output_location = execution["ResultConfiguration"]["OutputLocation"]
+    bucket, key = output_location.removeprefix("s3://").split("/", 1)
+
+    response = athena_client.get_query_results(
+        QueryExecutionId=execution_id, MaxResults=1
+    )
+    column_info = response["ResultSet"]["ResultSetMetadata"]["ColumnInfo"]
+
+    body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+    table = csv.read_csv(
+        body,
+        read_options=csv.ReadOptions(block_size=block_size),
+        convert_options=csv.ConvertOptions(
+            column_types={x["Name"]: get_arrow_type(x) for x in column_info},
+            null_values=[""],
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False,
+        ),
+    )
+    return {
+        "ColumnInfo": column_info,
+        "Table": table,
     }
 
-    response = athena_client.start_query_execution(**start_args)
-    execution_id = response["QueryExecutionId"]
 
-    # Poll for completion
-    while True:
-        status_response = athena_client.get_query_execution(
-            QueryExecutionId=execution_id
+def get_json_object(s3_client, bucket: str, key: str) -> tuple[dict | None, str | None]:
+    # Returns the parsed object and its ETag, or (None, None) if it is missing
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return None, None
+    return json.loads(response["Body"].read()), response["ETag"]
+
+
+def get_sequence_key(log_table: str, prefix: str = SEQUENCE_PREFIX) -> str:
+    return f"{prefix}/{log_table}.json"
+
+
+def check_conditional_writes(s3_client) -> None:
+    # IfMatch and IfNoneMatch on put_object need botocore 1.35.x. Checked up
+    # front so an older SDK fails a run before it writes anything, not at its
+    # first compare-and-swap.
+    shape = s3_client.meta.service_model.operation_model("PutObject").input_shape
+    if not {"IfMatch", "IfNoneMatch"} <= set(shape.members):
+        raise RuntimeError(
+            f"botocore {botocore.__version__} does not support conditional S3 writes, 1.35.90 or later is required."
         )
-        status = status_response["QueryExecution"]["Status"]["State"]
+    return
 
-        if status == "SUCCEEDED":
-            break
-        if status in ("FAILED", "CANCELLED"):
-            reason = status_response["QueryExecution"]["Status"].get(
-                "StateChangeReason", "Unknown error"
-            )
-            raise RuntimeError(f"Athena query {status.lower()}: {reason}")
 
-        time.sleep(poll_interval)
+def put_json_object(
+    s3_client, bucket: str, key: str, body: dict, etag: str | None = None
+) -> str | None:
+    # Compare-and-swap write: succeeds only if the object still has etag, or
+    # does not exist yet when etag is None. Returns the new ETag, or None if
+    # another writer won.
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    try:
+        response = s3_client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=json.dumps(body),
+            ContentType="application/json",
+            **condition,
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in (
+            "PreconditionFailed",
+            "ConditionalRequestConflict",
+        ):
+            return None
+        raise
+    return response["ETag"]
 
-    # Paginate results
-    if return_result:
-        all_rows = []
-        column_info = None
-        next_token = None
-        is_first_page = True
 
-        page_args = {
-            "QueryExecutionId": execution_id,
-            "MaxResults": page_size,
-        }
+class AthenaQueryCache:
+    """
+    Client-side cache for small, repeated read queries. Entries are keyed by
+    the whitespace-normalized SQL plus the current Iceberg metadata location
+    of every table the query reads, so any commit to those tables misses the
+    cache. Entries also expire after ttl seconds and the least recently used
+    are evicted past max_entries. With cache_dir set, entries are kept as
+    JSON files there (e.g. under /tmp to survive warm Lambda invocations),
+    otherwise in memory. result_reuse_max_age additionally turns on Athena
+    query result reuse for the queries that miss.
+    """
 
-        while True:
-            response = athena_client.get_query_results(**page_args)
+    def __init__(
+        self,
+        glue_client=None,
+        database: str = "metadata",
+        ttl: float = 900,
+        max_entries: int = 256,
+        cache_dir: str | None = None,
+        result_reuse_max_age: int | None = None,
+    ):
+        self.glue_client = glue_client or boto3.client("glue")
+        self.database = database
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.result_reuse_max_age = result_reuse_max_age
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, query: str) -> str | None:
+        normalized = " ".join(query.split())
+        if not normalized.lower().startswith(("select", "with")):
+            return None
+
+        tables = sorted(
+            {
+                (database or self.database, table)
+                for database, table in TABLE_REFERENCE_PATTERN.findall(normalized)
+            }
+        )
+        if not tables:
+            return None
+
+        snapshots = []
+        for database, table in tables:
+            try:
+                response = self.glue_client.get_table(DatabaseName=database, Name=table)
+            except self.glue_client.exceptions.EntityNotFoundException:
+                return None
+            metadata_location = (
+                response["Table"].get("Parameters", {}).get("metadata_location")
+            )
+            if metadata_location is None:
+                # Not an Iceberg table, so there is no snapshot to key on
+                return None
+            snapshots.append(f"{database}.{table}={metadata_location}")
+
+        key_source = "\n".join([normalized, *snapshots])
+        return hashlib.sha256(key_source.encode()).hexdigest()
 
-            if is_first_page:
-                column_info = response["ResultSet"]["ResultSetMetadata"]["ColumnInfo"]
-                all_rows.extend([x["Data"] for x in response["ResultSet"]["Rows"][1:]])
-                is_first_page = False
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            if self.cache_dir:
+                path = os.path.join(self.cache_dir, f"{key}.json")
+                try:
+                    with open(path) as f:
+                        entry = json.load(f)
+                    expires_at, result = entry["expires_at"], entry["result"]
+                except FileNotFoundError:
+                    return None
+                except (ValueError, KeyError, TypeError):
+                    # Unreadable entries are dropped and count as a miss
+                    os.remove(path)
+                    return None
+                os.utime(path)
             else:
-                all_rows.extend([x["Data"] for x in response["ResultSet"]["Rows"][1:]])
+                if key not in self._entries:
+                    return None
+                expires_at, result = self._entries[key]
+                self._entries.move_to_end(key)
 
-            next_token = response.get("NextToken")
-            if not next_token:
-                break
+        if expires_at < time.time():
+            return None
+        return result
+
+    def put(self, key: str, result: dict) -> None:
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            if self.cache_dir:
+                # Written to a temporary file first, so a write cut short
+                # (e.g. by a Lambda timeout) never leaves a partial entry
+                path = os.path.join(self.cache_dir, f"{key}.json")
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump({"expires_at": expires_at, "result": result}, f)
+                os.replace(tmp_path, path)
+                paths = sorted(
+                    (
+                        os.path.join(self.cache_dir, x)
+                        for x in os.listdir(self.cache_dir)
+                    ),
+                    key=os.path.getmtime,
+                )
+                for stale_path in paths[: -self.max_entries]:
+                    os.remove(stale_path)
             else:
-                page_args["NextToken"] = next_token
+                self._entries[key] = (expires_at, result)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return
 
-        return {
-            "Status": status,
-            "ColumnInfo": column_info,
-            "Rows": all_rows,
-        }
-    else:
-        return {"Status": status}
+
+def run_athena_query(
+    query: str,
+    athena_client=None,
+    return_result: bool = True,
+    poll_interval: float = 1.0,
+    page_size: int = 1000,
+    result_format: str = "rows",
+    cache: AthenaQueryCache | None = None,
+) -> dict:
+    executor = get_athena_executor(athena_client, max_poll_interval=poll_interval)
+    if cache is None or not return_result or result_format == "arrow":
+        return executor.submit(query, return_result, page_size, result_format).result()
+
+    # Cached entries hold the raw rows so they stay JSON serializable,
+    # typed rows are decoded on the way out
+    key = cache.get_key(query)
+    result = cache.get(key) if key else None
+    if result is None:
+        result = executor.submit(
+            query,
+            return_result,
+            page_size,
+            result_reuse_max_age=cache.result_reuse_max_age,
+        ).result()
+        if key:
+            cache.put(key, result)
+
+    if result_format == "typed":
+        decode = get_row_decoder(result["ColumnInfo"])
+        result = {**result, "Rows": [decode(x) for x in result["Rows"]]}
+    return result
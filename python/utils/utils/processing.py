@@ -1,8 +1,42 @@
-from utils.common import run_athena_query
+import json
+import time
+from collections import namedtuple
+from typing import Iterator
+
+from utils.common import (
+    ALLOCATION_TIMEOUT_SECONDS,
+    SEQUENCE_PREFIX,
+    AthenaQueryCache,
+    get_json_object,
+    get_sequence_key,
+    iter_athena_query_rows,
+    put_json_object,
+    run_athena_query,
+)
+
+
+CHECKPOINT_PREFIX = "checkpoints"
+
+IngestEvent = namedtuple(
+    "IngestEvent",
+    [
+        "event_id",
+        "ingest_ts",
+        "event_producer",
+        "event_type",
+        "source_system",
+        "file_md5_hash",
+        "s3_location",
+        "payload",
+    ],
+)
 
 
 def get_process_event_id_hwm(
-    event_consumer: str, athena_client, log_table: str = "metadata.data_process_log"
+    event_consumer: str,
+    athena_client,
+    log_table: str = "metadata.data_process_log",
+    cache: AthenaQueryCache | None = None,
 ) -> int:
     read_sql = f"""
         select current_event_hwm
@@ -10,10 +44,11 @@ def get_process_event_id_hwm(
         where event_consumer = '{event_consumer}'
         limit 1
     """
-    result = run_athena_query(read_sql, athena_client)
-    rows = result.get("Rows", [])
-    if len(rows) > 0:
-        event_id_hwm = int(rows[0][0].get("VarCharValue", -1))
+    rows = run_athena_query(
+        read_sql, athena_client, result_format="typed", cache=cache
+    )["Rows"]
+    if len(rows) > 0 and rows[0].current_event_hwm is not None:
+        event_id_hwm = rows[0].current_event_hwm
     else:
         event_id_hwm = -1
     return event_id_hwm
@@ -35,16 +70,105 @@ def set_process_event_id_hwm(
 
 
 def get_latest_ingest_event_id(
-    athena_client, log_table: str = "metadata.data_ingest_log"
+    athena_client,
+    log_table: str = "metadata.data_ingest_log",
+    cache: AthenaQueryCache | None = None,
 ) -> int:
     read_sql = f"""
-        select coalesce(max(event_id),-1)
+        select coalesce(max(event_id),-1) as latest_event_id
         from {log_table}
     """
-    latest_event_id = int(
-        run_athena_query(read_sql, athena_client)["Rows"][0][0]["VarCharValue"]
+    result = run_athena_query(
+        read_sql, athena_client, result_format="typed", cache=cache
+    )
+    return result["Rows"][0].latest_event_id
+
+
+def get_pending_event_ids(
+    s3_client,
+    bucket: str,
+    log_table: str = "metadata.data_ingest_log",
+    prefix: str = SEQUENCE_PREFIX,
+    timeout: int = ALLOCATION_TIMEOUT_SECONDS,
+) -> list[int]:
+    # Ids handed to producers that have not inserted or released them yet.
+    # Read this before the log: an id missing from both was abandoned, and an
+    # id missing here but inserted is visible in the later log read.
+    sequence, _ = get_json_object(
+        s3_client, bucket, get_sequence_key(log_table, prefix)
+    )
+    if sequence is None:
+        return []
+    now = time.time()
+    return sorted(
+        int(k) for k, v in sequence.get("pending", {}).items() if now - v < timeout
     )
-    return latest_event_id
+
+
+def read_pending_events(
+    event_id_hwm: int,
+    athena_client,
+    max_event_id: int | None = None,
+    event_producer: str | None = None,
+    event_type: str | None = None,
+    log_table: str = "metadata.data_ingest_log",
+) -> Iterator[IngestEvent]:
+    # One range query for every event after the hwm, streamed in event order
+    filters = [f"event_id > {event_id_hwm}"]
+    if max_event_id is not None:
+        filters.append(f"event_id <= {max_event_id}")
+    if event_producer is not None:
+        filters.append(f"event_producer = '{event_producer}'")
+    if event_type is not None:
+        filters.append(f"event_type = '{event_type}'")
+    where_sql = " and ".join(filters)
+
+    read_sql = f"""
+        select
+            event_id,
+            ingest_ts,
+            event_producer,
+            event_type,
+            source_system,
+            file_md5_hash,
+            json_extract_scalar(payload, '$.s3_location') as s3_location,
+            payload
+        from {log_table}
+        where {where_sql}
+        order by event_id
+    """
+    for row in iter_athena_query_rows(read_sql, athena_client):
+        payload = json.loads(row.payload) if row.payload else {}
+        yield IngestEvent(*row[:-1], payload)
+
+
+def get_last_file_event(
+    event_id: int,
+    athena_client,
+    log_table: str = "metadata.data_ingest_log",
+) -> IngestEvent | None:
+    # The latest event at or before event_id that delivered a file
+    read_sql = f"""
+        select
+            event_id,
+            ingest_ts,
+            event_producer,
+            event_type,
+            source_system,
+            file_md5_hash,
+            json_extract_scalar(payload, '$.s3_location') as s3_location,
+            payload
+        from {log_table}
+        where event_id <= {event_id}
+        and json_extract_scalar(payload, '$.s3_location') is not null
+        order by event_id desc
+        limit 1
+    """
+    rows = run_athena_query(read_sql, athena_client, result_format="typed")["Rows"]
+    if not rows:
+        return None
+    payload = json.loads(rows[0].payload) if rows[0].payload else {}
+    return IngestEvent(*rows[0][:-1], payload)
 
 
 def insert_row_to_process_log(
@@ -72,3 +196,157 @@ def insert_row_to_process_log(
         set_process_event_id_hwm(event_consumer, event_id, athena_client, log_table)
 
     return
+
+
+class ConsumerCheckpoint:
+    """
+    High-water mark of one consumer, kept as a small JSON object in S3 and
+    updated with compare-and-swap. Reads and writes are a single request each,
+    independent of the size of the process log.
+    """
+
+    def __init__(
+        self,
+        event_consumer: str,
+        s3_client,
+        bucket: str,
+        prefix: str = CHECKPOINT_PREFIX,
+    ):
+        self.event_consumer = event_consumer
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = f"{prefix}/{event_consumer}.json"
+        self._etag = None
+
+    def read(
+        self, athena_client=None, log_table: str = "metadata.data_process_log"
+    ) -> int:
+        checkpoint, self._etag = get_json_object(self.s3_client, self.bucket, self.key)
+        if checkpoint is not None:
+            return checkpoint["event_id_hwm"]
+
+        # No checkpoint yet, carry over the hwm tracked in the process log
+        if athena_client is not None:
+            return get_process_event_id_hwm(
+                self.event_consumer, athena_client, log_table
+            )
+        return -1
+
+    def write(self, event_id_hwm: int) -> None:
+        etag = put_json_object(
+            self.s3_client,
+            self.bucket,
+            self.key,
+            {"event_consumer": self.event_consumer, "event_id_hwm": event_id_hwm},
+            self._etag,
+        )
+        if etag is None:
+            raise RuntimeError(
+                f"Checkpoint for {self.event_consumer} was changed by another writer."
+            )
+        self._etag = etag
+        return
+
+
+class ProcessLogWriter:
+    """
+    Buffers process-log rows for a consumer and writes them, together with
+    the hwm advance, in a single MERGE per flush instead of a SELECT, INSERT
+    and UPDATE per event. Rows are matched on process_id, so flushing rows
+    that were already written by a failed run only advances the hwm.
+
+    With a checkpoint, the hwm is advanced there instead and the process log
+    only receives the new audit rows.
+    """
+
+    def __init__(
+        self,
+        event_consumer: str,
+        athena_client,
+        flush_every: int = 100,
+        log_table: str = "metadata.data_process_log",
+        event_id_hwm: int | None = None,
+        checkpoint: ConsumerCheckpoint | None = None,
+    ):
+        self.event_consumer = event_consumer
+        self.athena_client = athena_client
+        self.flush_every = flush_every
+        self.log_table = log_table
+        self.checkpoint = checkpoint
+        if event_id_hwm is None and checkpoint is not None:
+            event_id_hwm = checkpoint.read(athena_client, log_table)
+        elif event_id_hwm is None:
+            event_id_hwm = get_process_event_id_hwm(
+                event_consumer, athena_client, log_table
+            )
+        self.event_id_hwm = event_id_hwm
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def add(self, event_id: int, process_detail: str) -> None:
+        self._rows.append((event_id, process_detail))
+        if len(self._rows) >= self.flush_every:
+            self.flush()
+        return
+
+    def flush(self) -> None:
+        if not self._rows:
+            return
+
+        event_id_hwm = max(self.event_id_hwm, *[x[0] for x in self._rows])
+        process_ids = []
+        values = []
+        for event_id, process_detail in self._rows:
+            process_id = f"{self.event_consumer}_{event_id}"
+            process_detail = process_detail.replace("'", "''")
+            process_ids.append(f"'{process_id}'")
+            values.append(
+                f"('{process_id}', '{self.event_consumer}', {event_id}, "
+                f"{event_id_hwm}, cast(current_timestamp as timestamp(6)), '{process_detail}')"
+            )
+        values = ",\n".join(values)
+        process_id_list = ", ".join(process_ids)
+
+        source_sql = f"""
+            select *
+            from (values
+                {values}
+            ) as v (process_id, event_consumer, event_id, current_event_hwm, process_ts, process_detail)
+        """
+        matched_sql = ""
+        if self.checkpoint is None:
+            # The hwm lives on every row of the consumer, advance it in place
+            source_sql += f"""
+            union all
+            select process_id, event_consumer, event_id, {event_id_hwm}, process_ts, process_detail
+            from {self.log_table}
+            where event_consumer = '{self.event_consumer}'
+            and current_event_hwm < {event_id_hwm}
+            and process_id not in ({process_id_list})
+            """
+            matched_sql = """
+            when matched and t.current_event_hwm < s.current_event_hwm then
+                update set current_event_hwm = s.current_event_hwm
+            """
+
+        merge_sql = f"""
+            merge into {self.log_table} t
+            using ({source_sql}) s
+            on t.process_id = s.process_id
+            {matched_sql}
+            when not matched then
+                insert (process_id, event_consumer, event_id, current_event_hwm, process_ts, process_detail)
+                values (s.process_id, s.event_consumer, s.event_id, s.current_event_hwm, s.process_ts, s.process_detail)
+        """
+        run_athena_query(merge_sql, self.athena_client, False)
+        if self.checkpoint is not None and event_id_hwm > self.event_id_hwm:
+            self.checkpoint.write(event_id_hwm)
+
+        self.event_id_hwm = event_id_hwm
+        self._rows = []
+        return
@@ -0,0 +1,20 @@
+from utils.validation import validate_csv_file
+
+
+FILENAME = "openpowerlifting-2026-02-21-6461ed68.csv"
+
+
+def main():
+    # Same report as pydantic_test.py, from the columnar validator in
+    # utils.validation. Run with python/utils on PYTHONPATH.
+    valid_count, invalid_count, invalid_rows = validate_csv_file(FILENAME)
+
+    print("Invalid_rows: ")
+    for row in invalid_rows:
+        print(row)
+    print(f"Valid count: {valid_count}")
+    print(f"Invalid count: {invalid_count}")
+
+
+if __name__ == "__main__":
+    main()
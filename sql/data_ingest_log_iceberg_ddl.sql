@@ -7,7 +7,7 @@ CREATE TABLE IF NOT EXISTS metadata.data_ingest_log (
     file_md5_hash   string,
     payload         string
 )
-PARTITIONED BY (bucket(16, event_id)) 
+PARTITIONED BY (truncate(1000, event_id)) 
 LOCATION 's3://dev-use2-tedsand-iceberg-s3/warehouse/metadata.db/data_ingest_log' 
 TBLPROPERTIES (
   'table_type'='ICEBERG',
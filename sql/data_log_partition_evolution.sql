@@ -0,0 +1,9 @@
+-- Spark SQL, run from a Glue job or notebook with the Iceberg extensions enabled.
+-- Moves the log tables from hash buckets to event_id ranges so that reads of
+-- the events after a consumer's hwm only touch the newest partitions.
+-- Existing files keep their old layout until they are rewritten.
+ALTER TABLE glue_catalog.metadata.data_ingest_log
+REPLACE PARTITION FIELD event_id_bucket WITH truncate(1000, event_id);
+
+ALTER TABLE glue_catalog.metadata.data_process_log
+REPLACE PARTITION FIELD event_id_bucket WITH truncate(1000, event_id);
@@ -6,7 +6,7 @@ CREATE TABLE IF NOT EXISTS metadata.data_process_log (
     process_ts            timestamp,
     process_detail        string
 )
-PARTITIONED BY (event_consumer, bucket(16, event_id)) 
+PARTITIONED BY (event_consumer, truncate(1000, event_id)) 
 LOCATION 's3://dev-use2-tedsand-iceberg-s3/warehouse/metadata.db/data_process_log' 
 TBLPROPERTIES (
   'table_type'='ICEBERG',
@@ -3,45 +3,46 @@ CREATE TABLE IF NOT EXISTS cleansed.openpowerlifting (
   sex string,
   event string,
   equipment string,
-  age string,
+  age double,
   age_class string,
   birth_year_class string,
   division string,
-  bodyweight_kg string,
+  bodyweight_kg double,
   weightclass_kg string,
-  squat_1_kg string,
-  squat_2_kg string,
-  squat_3_kg string,
-  squat_4_kg string,
-  best_3_squat_kg string,
-  bench_1_kg string,
-  bench_2_kg string,
-  bench_3_kg string,
-  bench_4_kg string,
-  best_3_bench_kg string,
-  deadlift_1_kg string,
-  deadlift_2_kg string,
-  deadlift_3_kg string,
-  deadlift_4_kg string,
-  best_3_deadlift_kg string,
-  total_kg string,
+  squat_1_kg double,
+  squat_2_kg double,
+  squat_3_kg double,
+  squat_4_kg double,
+  best_3_squat_kg double,
+  bench_1_kg double,
+  bench_2_kg double,
+  bench_3_kg double,
+  bench_4_kg double,
+  best_3_bench_kg double,
+  deadlift_1_kg double,
+  deadlift_2_kg double,
+  deadlift_3_kg double,
+  deadlift_4_kg double,
+  best_3_deadlift_kg double,
+  total_kg double,
   place string,
-  dots string,
-  wilks string,
-  glossbrenner string,
-  goodlift string,
-  tested string,
+  dots double,
+  wilks double,
+  glossbrenner double,
+  goodlift double,
+  tested boolean,
   country string,
   state string,
   federation string,
   parent_federation string,
-  date string,
+  date date,
   meet_country string,
   meet_state string,
   meet_town string,
   meet_name string,
-  sanctioned string,
+  sanctioned boolean,
   row_hash string,
+  row_fingerprint bigint,
   source_system string,
   source_table string,
   inserted_at timestamp,
@@ -50,7 +51,7 @@ CREATE TABLE IF NOT EXISTS cleansed.openpowerlifting (
   job_run_id string,
   is_deleted boolean
  ) 
-PARTITIONED BY (bucket(16, row_hash)) 
+PARTITIONED BY (year(date)) 
 LOCATION 's3://dev-use2-tedsand-iceberg-s3/warehouse/cleansed.db/openpowerlifting' 
 TBLPROPERTIES (
   'table_type'='ICEBERG',
@@ -0,0 +1,26 @@
+-- Spark SQL, run from a Glue job or notebook with the Iceberg extensions enabled.
+-- Sets the write layout of the cleansed table. Iceberg applies it to every
+-- writer, including the cleanse job's appends and MERGEs:
+-- - rows are distributed by partition (meet year) and sorted by name and date
+--   within each file, so lifter and meet lookups get tight min/max ranges
+-- - files target 128 MB
+-- - a Parquet bloom filter on row_fingerprint lets lookups of literal keys
+--   (WHERE row_fingerprint = ... or IN (...)) skip row groups. Joins on the
+--   key, like the soft-delete MERGE, do not use it.
+-- - row-level updates and deletes are merge-on-read, so soft deletes write small
+--   position delete files instead of rewriting every data file they touch
+-- Existing files only pick up the layout and bloom filters once they are
+-- rewritten.
+ALTER TABLE glue_catalog.cleansed.openpowerlifting SET TBLPROPERTIES (
+  'format-version' = '2',
+  'write.parquet.bloom-filter-enabled.column.row_fingerprint' = 'true',
+  'write.parquet.bloom-filter-max-bytes' = '1048576',
+  'write.distribution-mode' = 'hash',
+  'write.target-file-size-bytes' = '134217728',
+  'write.update.mode' = 'merge-on-read',
+  'write.merge.mode' = 'merge-on-read',
+  'write.delete.mode' = 'merge-on-read'
+);
+
+ALTER TABLE glue_catalog.cleansed.openpowerlifting
+WRITE DISTRIBUTED BY PARTITION LOCALLY ORDERED BY name, date;
@@ -0,0 +1,11 @@
+-- Spark SQL, run from a Glue job or notebook with the Iceberg extensions enabled.
+-- Moves the cleansed table from row key buckets to meet years so that lookups
+-- filtered on date only read the matching years. Existing files keep their old
+-- layout until they are rewritten by the maintenance job.
+-- This drops the only pruning on the row key. The cleanse job's soft deletes
+-- (an anti-join of the live keys against the latest file, then a MERGE on the
+-- deleted keys) read the key column of the whole table on every run that
+-- includes the latest file. Bloom filters do not help with joins. New rows are
+-- deduped against the previous dump and do not scan the table.
+ALTER TABLE glue_catalog.cleansed.openpowerlifting
+REPLACE PARTITION FIELD bucket(16, row_fingerprint) WITH year(date);
@@ -0,0 +1,61 @@
+-- Spark SQL, run from a Glue job or notebook with the Iceberg extensions enabled.
+-- Adds the 64-bit row_fingerprint next to row_hash, backfills it with the same
+-- xxhash64 the cleanse job uses and moves the buckets and bloom filter over to
+-- it. Run before switching the job's --row_key to row_fingerprint.
+-- The backfill relies on the source columns still being the raw strings.
+ALTER TABLE glue_catalog.cleansed.openpowerlifting
+ADD COLUMN row_fingerprint bigint AFTER row_hash;
+
+UPDATE glue_catalog.cleansed.openpowerlifting
+SET row_fingerprint = xxhash64(
+  coalesce(name, ''),
+  coalesce(sex, ''),
+  coalesce(event, ''),
+  coalesce(equipment, ''),
+  coalesce(age, ''),
+  coalesce(age_class, ''),
+  coalesce(birth_year_class, ''),
+  coalesce(division, ''),
+  coalesce(bodyweight_kg, ''),
+  coalesce(weightclass_kg, ''),
+  coalesce(squat_1_kg, ''),
+  coalesce(squat_2_kg, ''),
+  coalesce(squat_3_kg, ''),
+  coalesce(squat_4_kg, ''),
+  coalesce(best_3_squat_kg, ''),
+  coalesce(bench_1_kg, ''),
+  coalesce(bench_2_kg, ''),
+  coalesce(bench_3_kg, ''),
+  coalesce(bench_4_kg, ''),
+  coalesce(best_3_bench_kg, ''),
+  coalesce(deadlift_1_kg, ''),
+  coalesce(deadlift_2_kg, ''),
+  coalesce(deadlift_3_kg, ''),
+  coalesce(deadlift_4_kg, ''),
+  coalesce(best_3_deadlift_kg, ''),
+  coalesce(total_kg, ''),
+  coalesce(place, ''),
+  coalesce(dots, ''),
+  coalesce(wilks, ''),
+  coalesce(glossbrenner, ''),
+  coalesce(goodlift, ''),
+  coalesce(tested, ''),
+  coalesce(country, ''),
+  coalesce(state, ''),
+  coalesce(federation, ''),
+  coalesce(parent_federation, ''),
+  coalesce(date, ''),
+  coalesce(meet_country, ''),
+  coalesce(meet_state, ''),
+  coalesce(meet_town, ''),
+  coalesce(meet_name, ''),
+  coalesce(sanctioned, '')
+);
+
+ALTER TABLE glue_catalog.cleansed.openpowerlifting
+REPLACE PARTITION FIELD row_hash_bucket WITH bucket(16, row_fingerprint);
+
+ALTER TABLE glue_catalog.cleansed.openpowerlifting SET TBLPROPERTIES (
+  'write.parquet.bloom-filter-enabled.column.row_hash' = 'false',
+  'write.parquet.bloom-filter-enabled.column.row_fingerprint' = 'true'
+);
@@ -0,0 +1,72 @@
+-- Spark SQL, run from a Glue job or notebook with the Iceberg extensions enabled.
+-- Iceberg cannot change a string column to a numeric or date type in place, so
+-- the typed table is built with CTAS and swapped in by rename. Run
+-- openpowerlifting_row_fingerprint_migration.sql first, its backfill needs the
+-- raw string columns, and rerun openpowerlifting_iceberg_properties.sql after
+-- the swap. Drop openpowerlifting_untyped once the new table checks out.
+CREATE TABLE glue_catalog.cleansed.openpowerlifting_typed
+USING iceberg
+PARTITIONED BY (bucket(16, row_fingerprint))
+TBLPROPERTIES (
+  'format-version' = '2',
+  'write.parquet.compression-codec' = 'snappy'
+)
+AS SELECT
+  name,
+  sex,
+  event,
+  equipment,
+  cast(age as double) as age,
+  age_class,
+  birth_year_class,
+  division,
+  cast(bodyweight_kg as double) as bodyweight_kg,
+  weightclass_kg,
+  cast(squat_1_kg as double) as squat_1_kg,
+  cast(squat_2_kg as double) as squat_2_kg,
+  cast(squat_3_kg as double) as squat_3_kg,
+  cast(squat_4_kg as double) as squat_4_kg,
+  cast(best_3_squat_kg as double) as best_3_squat_kg,
+  cast(bench_1_kg as double) as bench_1_kg,
+  cast(bench_2_kg as double) as bench_2_kg,
+  cast(bench_3_kg as double) as bench_3_kg,
+  cast(bench_4_kg as double) as bench_4_kg,
+  cast(best_3_bench_kg as double) as best_3_bench_kg,
+  cast(deadlift_1_kg as double) as deadlift_1_kg,
+  cast(deadlift_2_kg as double) as deadlift_2_kg,
+  cast(deadlift_3_kg as double) as deadlift_3_kg,
+  cast(deadlift_4_kg as double) as deadlift_4_kg,
+  cast(best_3_deadlift_kg as double) as best_3_deadlift_kg,
+  cast(total_kg as double) as total_kg,
+  place,
+  cast(dots as double) as dots,
+  cast(wilks as double) as wilks,
+  cast(glossbrenner as double) as glossbrenner,
+  cast(goodlift as double) as goodlift,
+  cast(tested as boolean) as tested,
+  country,
+  state,
+  federation,
+  parent_federation,
+  cast(date as date) as date,
+  meet_country,
+  meet_state,
+  meet_town,
+  meet_name,
+  cast(sanctioned as boolean) as sanctioned,
+  row_hash,
+  row_fingerprint,
+  source_system,
+  source_table,
+  inserted_at,
+  job_name,
+  job_id,
+  job_run_id,
+  is_deleted
+FROM glue_catalog.cleansed.openpowerlifting;
+
+ALTER TABLE glue_catalog.cleansed.openpowerlifting
+RENAME TO glue_catalog.cleansed.openpowerlifting_untyped;
+
+ALTER TABLE glue_catalog.cleansed.openpowerlifting_typed
+RENAME TO glue_catalog.cleansed.openpowerlifting;
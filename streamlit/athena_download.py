@@ -1,4 +1,7 @@
 import awswrangler as wr
+import duckdb
+
+from build_rollup import build_rollup
 
 
 def main() -> None:
@@ -10,6 +13,9 @@ def main() -> None:
     )
     df.to_parquet("lifter.parquet")
 
+    # Rebuild the profiler's rollup so it matches the new file
+    build_rollup(duckdb.connect(), "lifter.parquet")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,64 @@
+import duckdb
+import os
+
+
+NUMERIC_TYPES = ["INTEGER", "FLOAT"]
+ROLLUP_FILENAME = "lifter_rollup.parquet"
+STAT_COLUMNS = ["count", "sum", "sum_sq", "min", "max", "median"]
+
+
+def get_rollup_sql(parquet_file: str, col_grouping: str, numeric_cols: list) -> str:
+    # One scan per grouping column. Each group gets a row per argument, with
+    # '*' holding the row count for Count(*).
+    stats = [
+        "{'argument_column': '*', 'count': count(*), "
+        + ", ".join(f"'{x}': NULL::DOUBLE" for x in STAT_COLUMNS[1:])
+        + "}"
+    ]
+    for x in numeric_cols:
+        stats.append(
+            f"{{'argument_column': '{x}', 'count': count({x}), 'sum': sum({x})::DOUBLE, 'sum_sq': sum({x}::DOUBLE * {x}), 'min': min({x})::DOUBLE, 'max': max({x})::DOUBLE, 'median': median({x})::DOUBLE}}"
+        )
+    stats_sql = ", ".join(stats)
+    return f"""
+        SELECT grouping_column, group_value, unnest(stats, recursive := true)
+        FROM (
+            SELECT
+                '{col_grouping}' AS grouping_column,
+                {col_grouping}::VARCHAR AS group_value,
+                [{stats_sql}] AS stats
+            FROM '{parquet_file}'
+            WHERE {col_grouping} IS NOT NULL
+            GROUP BY ALL
+        )
+    """
+
+
+def build_rollup(con, parquet_file: str, rollup_file: str = ROLLUP_FILENAME) -> int:
+    # Long format rollup: (grouping_column, group_value, argument_column) and
+    # the stats every profiler function can be answered from. Written to a
+    # temporary file first so the profiler never reads a partial rollup, and
+    # sorted on the lookup columns so a lookup only reads its row groups.
+    cols = con.sql(f"DESCRIBE SELECT * FROM '{parquet_file}'").fetchall()
+    numeric_cols = [x[0] for x in cols if x[1] in NUMERIC_TYPES]
+    grouping_cols = [x[0] for x in cols if x[1] not in NUMERIC_TYPES]
+
+    rollup_sql = " UNION ALL ".join(
+        get_rollup_sql(parquet_file, x, numeric_cols) for x in grouping_cols
+    )
+    tmp_file = f"{rollup_file}.tmp"
+    con.sql(
+        f"COPY ({rollup_sql} ORDER BY grouping_column, argument_column) TO '{tmp_file}' (FORMAT parquet, COMPRESSION zstd)"
+    )
+    os.replace(tmp_file, rollup_file)
+    return con.sql(f"SELECT count(*) FROM '{rollup_file}'").fetchone()[0]
+
+
+def main() -> None:
+    filename = "lifter.parquet"
+    num_rows = build_rollup(duckdb.connect(), filename)
+    print(f"Wrote {num_rows} rows to {ROLLUP_FILENAME}")
+
+
+if __name__ == "__main__":
+    main()
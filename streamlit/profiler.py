@@ -2,32 +2,74 @@ import streamlit as st
 import duckdb
 import os
 
+from build_rollup import NUMERIC_TYPES, ROLLUP_FILENAME
+
+
+# Aggregation results are small, so a bounded number of them are kept per
+# process. Entries are keyed by the selection and the file's mtime, so a new
+# download invalidates them.
+RESULT_CACHE_ENTRIES = 256
+# Each profiler function in terms of the rollup's stats columns
+ROLLUP_EXPRESSIONS = {
+    "COUNT": "count",
+    "SUM": "sum",
+    "AVG": "sum / nullif(count, 0)",
+    "MEDIAN": "median",
+    "MIN": "min",
+    "MAX": "max",
+    "STDDEV": "sqrt(greatest(sum_sq - sum * sum / count, 0) / nullif(count - 1, 0))",
+    "VARIANCE": "greatest(sum_sq - sum * sum / count, 0) / nullif(count - 1, 0)",
+}
+
 
 def main() -> None:
     print("start")
     st.markdown("## Lifter Data Profiler")
     col1, col2 = st.columns([1, 2])
 
+    @st.cache_resource
+    def get_connection():
+        # One connection for the life of the app. Queries scan the parquet file
+        # directly, so nothing is loaded into memory up front.
+        return duckdb.connect()
+
     @st.cache_data
-    def read_columns(parquet_file):
+    def read_columns(parquet_file, mtime):
         # Read column data from parquet
-        return duckdb.sql(f"DESCRIBE SELECT * FROM '{parquet_file}'").df()
+        con = get_connection().cursor()
+        return con.sql(f"DESCRIBE SELECT * FROM '{parquet_file}'").df()
 
-    @st.cache_data
-    def read_data(parquet_file):
-        # Read data from parquet
-        return duckdb.sql(f"SELECT * FROM '{parquet_file}'").df()
+    @st.cache_data(max_entries=RESULT_CACHE_ENTRIES)
+    def run_aggregation(
+        parquet_file, rollup_file, col_grouping, sql_function, col_argument, mtime
+    ):
+        # Only the grouped result leaves DuckDB. Each call gets its own cursor
+        # since Streamlit sessions run on separate threads. The rollup answers
+        # without scanning the data, the parquet file is queried otherwise.
+        calculation_col = f"{sql_function.lower()}_{col_argument}".replace("*", "all")
+        if rollup_file is not None:
+            result_sql = f"SELECT group_value AS {col_grouping}, {ROLLUP_EXPRESSIONS[sql_function]} AS {calculation_col} FROM '{rollup_file}' WHERE grouping_column = '{col_grouping}' AND argument_column = '{col_argument}' ORDER BY 2 DESC"
+        else:
+            result_sql = f"SELECT {col_grouping}, {sql_function}({col_argument}) as {calculation_col} FROM '{parquet_file}' WHERE {col_grouping} IS NOT NULL GROUP BY 1 ORDER BY 2 DESC"
+        con = get_connection().cursor()
+        return result_sql, con.sql(result_sql).df().set_index(col_grouping)
 
     # Read columns and add columns.
     filename = "lifter.parquet"
     filesize = os.path.getsize(filename)
+    mtime = os.path.getmtime(filename)
+    # A rollup built before the last download is stale and skipped
+    rollup_file = None
+    if os.path.exists(ROLLUP_FILENAME) and os.path.getmtime(ROLLUP_FILENAME) >= mtime:
+        rollup_file = ROLLUP_FILENAME
     col1.write(f"File name: {filename}")
     col1.write(f"File size: {round(filesize / 1000000)}MB")
+    col1.write(f"Rollup: {rollup_file or 'not built, querying the file'}")
 
-    cols_df = read_columns(filename)
+    cols_df = read_columns(filename, mtime)
     cols_df["formatted_name"] = cols_df["column_name"].str.replace("_", " ").str.title()
     cols_df["is_numeric"] = [
-        True if x in ["INTEGER", "FLOAT"] else False for x in cols_df["column_type"]
+        True if x in NUMERIC_TYPES else False for x in cols_df["column_type"]
     ]
 
     grouping_options = cols_df[~cols_df["is_numeric"]]["formatted_name"].to_list()
@@ -67,10 +109,10 @@ def main() -> None:
         col_argument = cols_df.loc[
             cols_df["formatted_name"] == col_name_argument, "column_name"
         ].item()
-    calculation_col = f"{sql_function.lower()}_{col_argument}".replace("*", "all")
 
-    result_sql = f"SELECT {col_grouping}, {sql_function}({col_argument}) as {calculation_col} FROM 'lifter.parquet' WHERE {col_grouping} IS NOT NULL GROUP BY 1 ORDER BY 2 DESC"
-    result_df = duckdb.sql(result_sql).df().set_index(col_grouping)
+    result_sql, result_df = run_aggregation(
+        filename, rollup_file, col_grouping, sql_function, col_argument, mtime
+    )
     col2.markdown(f":blue-background[{result_sql}]")
     col2.write(result_df)
     col2.write(result_df.dtypes)
@@ -0,0 +1,235 @@
+import csv
+import io
+
+import pytest
+from pydantic import ValidationError
+
+from pydantic_test import Record
+from utils.schema import OPENPOWERLIFTING_HEADER
+from utils.validation import validate_csv_block
+
+
+BASE_ROW = {name: "" for name in OPENPOWERLIFTING_HEADER} | {
+    "Name": "Jane Doe",
+    "Sex": "F",
+    "Event": "SBD",
+    "Equipment": "Raw",
+    "Place": "1",
+    "Date": "2024-02-03",
+    "Sanctioned": "Yes",
+}
+
+FLOAT_VALUES = [
+    "",
+    "0",
+    "1",
+    "-1",
+    "1.5",
+    "-.5",
+    " 1",
+    "1 ",
+    "\t1\xa0",
+    "　1",
+    "\x1c1",
+    "​1",
+    " ",
+    "1_0",
+    "1__0",
+    "_1",
+    "1_",
+    "-_1",
+    "_-1",
+    "1._5",
+    "._5",
+    "_.5",
+    "1e1_0",
+    "i_nf",
+    "1.",
+    ".5",
+    ".",
+    "1e",
+    "e1",
+    "1e5",
+    "1E-5",
+    "+1",
+    "+-1",
+    "inf",
+    "-inf",
+    "Infinity",
+    "-Infinity",
+    "nan",
+    "NaN",
+    "-nan",
+    "1e400",
+    "-1e-400",
+    "-0",
+    "-0.0",
+    "00012",
+    "0x10",
+    "1,5",
+    "1 0",
+    "abc",
+    "１",
+]
+
+INT_VALUES = [
+    "",
+    "1",
+    " 2",
+    "1 ",
+    "\xa03",
+    "1_0",
+    "1__0",
+    "_1",
+    "-_1",
+    "+1",
+    "-1",
+    "1.0",
+    "1.00",
+    "1.",
+    ".0",
+    "1.5",
+    "1.0_0",
+    "1_0.00",
+    "1_.0",
+    "1e1",
+    "-0",
+    "00",
+    "99999999999999999999",
+    "DQ",
+    "DD",
+    "NS",
+    "G",
+    " DQ",
+    "dq",
+    "inf",
+    "nan",
+]
+
+DATE_VALUES = [
+    "",
+    "2024-02-03",
+    "2024-02-29",
+    "2023-02-29",
+    "2024-02-30",
+    "2024-13-01",
+    "2024-00-10",
+    "2024-01-00",
+    "0000-01-01",
+    "0001-01-01",
+    "9999-12-31",
+    "0000-02-30",
+    "0000-01-01T00:00",
+    "0000-01-01T01:00",
+    "2024-02-03T00:00",
+    "2024-02-03 00:00",
+    "2024-02-03t00:00",
+    "2024-02-03_00:00",
+    "2024-02-03T00:00:00",
+    "2024-02-03T00:00:00Z",
+    "2024-02-03T00:00:00z",
+    "2024-02-03T00:00Z",
+    "2024-02-03T00:00:00+01:00",
+    "2024-02-03T00:00:00+0100",
+    "2024-02-03T00:00:00-23:59",
+    "2024-02-03T00:00:00+24:00",
+    "2024-02-03T00:00:00+00:60",
+    "2024-02-03T00:00:00+01",
+    "2024-02-03T00:00:00.000",
+    "2024-02-03T00:00:00,0",
+    "2024-02-03T00:00:00.",
+    "2024-02-03T00:00:00.5",
+    "2024-02-03T01:00",
+    "2024-02-03T23:59:59.999999",
+    "2024-02-03T24:00",
+    "2024-02-03T00:00:60",
+    "2024-02-03T00",
+    "2024-02-03T0:00",
+    "2024-02-03  00:00",
+    "2024-02-03T00:00Zjunk",
+    " 2024-02-03",
+    "2024-02-03 ",
+    "2024-2-3",
+    "2024/02/03",
+    "+2024-01-01",
+]
+
+LITERAL_VALUES = ["", "M", "Mx", "m", " M", "Yes", "yes"]
+
+CASES = (
+    [("Age", x) for x in FLOAT_VALUES]
+    + [("BodyweightKg", x) for x in FLOAT_VALUES]
+    + [("Place", x) for x in INT_VALUES]
+    + [("Date", x) for x in DATE_VALUES]
+    + [("Sex", x) for x in LITERAL_VALUES]
+    + [("Tested", x) for x in LITERAL_VALUES]
+)
+
+
+def get_record_errors(row: dict) -> set:
+    try:
+        Record.model_validate(row)
+    except ValidationError as e:
+        return {(x["type"], x["loc"]) for x in e.errors()}
+    return set()
+
+
+def validate_rows(rows: list[dict]) -> list[set]:
+    block = io.StringIO()
+    csv.writer(block, lineterminator="\n").writerows(
+        [[row[x] for x in OPENPOWERLIFTING_HEADER] for row in rows]
+    )
+    header = ",".join(OPENPOWERLIFTING_HEADER).encode("utf-8")
+    valid, invalid_rows = validate_csv_block(
+        header, block.getvalue().encode("utf-8"), 2
+    )
+    errors = [set() for _ in rows]
+    for row in invalid_rows:
+        errors[row["line_number"] - 2] = {
+            (x["type"], tuple(x["loc"])) for x in row["errors"]
+        }
+    assert [not x for x in errors] == valid.tolist()
+    return errors
+
+
+def test_matches_record():
+    rows = [BASE_ROW | {name: value} for name, value in CASES]
+    errors = validate_rows(rows)
+    mismatches = [
+        (name, value, found, expected)
+        for (name, value), found, expected in zip(
+            CASES, errors, map(get_record_errors, rows)
+        )
+        if found != expected
+    ]
+    assert mismatches == []
+
+
+def test_results_do_not_depend_on_the_batch():
+    # Columns are cleaned or parsed differently when every value is plain,
+    # a row on its own has to get the same result as in a mixed block
+    rows = [BASE_ROW | {name: value} for name, value in CASES]
+    alone = [validate_rows([row])[0] for row in rows]
+    assert alone == validate_rows(rows)
+
+
+@pytest.mark.parametrize("value", ["0", "86400", "1700000000"])
+def test_rejects_unix_timestamp_dates(value):
+    # Deliberately stricter than Record, see OPENPOWERLIFTING_CONSTRAINTS
+    row = BASE_ROW | {"Date": value}
+    assert get_record_errors(row) in (
+        set(),
+        {("date_from_datetime_inexact", ("Date",))},
+    )
+    assert validate_rows([row]) == [{("date_from_datetime_parsing", ("Date",))}]
+
+
+@pytest.mark.parametrize("value", ["0-2", "00-87", "0__8", "+0-2"])
+def test_rejects_zero_prefixed_ints(value):
+    # Deliberately stricter than Record, see OPENPOWERLIFTING_CONSTRAINTS
+    row = BASE_ROW | {"Place": value}
+    assert get_record_errors(row) == set()
+    assert validate_rows([row])[0] == {
+        ("int_parsing", ("Place", "int")),
+        ("literal_error", ("Place", "literal['DQ','DD','NS','G']")),
+    }
@@ -89,3 +89,61 @@ resource "aws_glue_catalog_table" "openpowerlifting" {
   }
 
 }
+
+# Parquet copies written by the ingest Lambda. Partitions are projected so new
+# days are queryable without adding partitions.
+resource "aws_glue_catalog_table" "openpowerlifting_parquet" {
+  name          = var.glue_table_openpowerlifting_raw_parquet.name
+  database_name = var.glue_table_openpowerlifting_raw_parquet.database
+  table_type    = var.glue_table_openpowerlifting_raw_parquet.table_type
+
+  parameters = {
+    classification              = var.glue_table_openpowerlifting_raw_parquet.classification
+    "projection.enabled"        = "true"
+    "projection.year.type"      = "integer"
+    "projection.year.range"     = var.glue_table_openpowerlifting_raw_parquet.projection_year_range
+    "projection.month.type"     = "integer"
+    "projection.month.range"    = "1,12"
+    "projection.month.digits"   = "2"
+    "projection.day.type"       = "integer"
+    "projection.day.range"      = "1,31"
+    "projection.day.digits"     = "2"
+  }
+
+  storage_descriptor {
+    location      = "s3://${aws_s3_bucket.raw_data.bucket}/${var.glue_table_openpowerlifting_raw_parquet.s3_prefix}/"
+    input_format  = var.glue_table_openpowerlifting_raw_parquet.input_format
+    output_format = var.glue_table_openpowerlifting_raw_parquet.output_format
+
+    ser_de_info {
+      serialization_library = var.glue_table_openpowerlifting_raw_parquet.serialization_library
+    }
+
+    dynamic "columns" {
+      for_each = [
+        "name", "sex", "event", "equipment", "age", "ageclass", "birthyearclass",
+        "division", "bodyweightkg", "weightclasskg", "squat1kg", "squat2kg",
+        "squat3kg", "squat4kg", "best3squatkg", "bench1kg", "bench2kg", "bench3kg",
+        "bench4kg", "best3benchkg", "deadlift1kg", "deadlift2kg", "deadlift3kg",
+        "deadlift4kg", "best3deadliftkg", "totalkg", "place", "dots", "wilks",
+        "glossbrenner", "goodlift", "tested", "country", "state", "federation",
+        "parentfederation", "date", "meetcountry", "meetstate", "meettown",
+        "meetname", "sanctioned"
+      ]
+      content {
+        name    = columns.value
+        type    = "string"
+        comment = ""
+      }
+    }
+  }
+
+  dynamic "partition_keys" {
+    for_each = ["year", "month", "day"]
+    content {
+      name = partition_keys.value
+      type = "string"
+    }
+  }
+
+}
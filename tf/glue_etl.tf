@@ -33,6 +33,8 @@ resource "aws_glue_job" "openpowerlifting_cleanse_job" {
     var.glue_job_openpowerlifting_cleanse.default_arguments,
     {
       "--sns_topic_arn" = aws_sns_topic.lambda_results.arn,
+      "--state_bucket" = aws_s3_bucket.iceberg.id,
+      "--sequence_bucket" = aws_s3_bucket.raw_data.id,
       "--extra-py-files" = "s3://${aws_s3_bucket.python.id}/${aws_s3_object.utils_zip.key}"
     }
   )
@@ -45,6 +47,48 @@ resource "aws_glue_job" "openpowerlifting_cleanse_job" {
   role_arn          = aws_iam_role.glue_job_role.arn
 }
 
+resource "aws_s3_object" "iceberg_maintenance_job" {
+  bucket = aws_s3_bucket.python.id
+  key    = var.glue_job_iceberg_maintenance.s3_key
+
+  source = var.glue_job_iceberg_maintenance.script
+  etag   = filemd5(var.glue_job_iceberg_maintenance.script)
+}
+
+resource "aws_glue_job" "iceberg_maintenance_job" {
+  name              = var.glue_job_iceberg_maintenance.name
+  description       = var.glue_job_iceberg_maintenance.description
+  glue_version      = var.glue_job_iceberg_maintenance.glue_version
+  max_retries       = var.glue_job_iceberg_maintenance.max_retries
+  timeout           = var.glue_job_iceberg_maintenance.timeout
+  number_of_workers = var.glue_job_iceberg_maintenance.number_of_workers
+  worker_type       = var.glue_job_iceberg_maintenance.worker_type
+  execution_class   = var.glue_job_iceberg_maintenance.execution_class
+  default_arguments = merge(
+    var.glue_job_iceberg_maintenance.default_arguments,
+    {
+      "--sns_topic_arn" = aws_sns_topic.lambda_results.arn
+    }
+  )
+
+  command {
+    name            = var.glue_job_iceberg_maintenance.command
+    script_location = "s3://${aws_s3_object.iceberg_maintenance_job.bucket}/${aws_s3_object.iceberg_maintenance_job.key}"
+  }
+
+  role_arn          = aws_iam_role.glue_job_role.arn
+}
+
+resource "aws_glue_trigger" "iceberg_maintenance" {
+  name     = var.glue_trigger_iceberg_maintenance.name
+  type     = var.glue_trigger_iceberg_maintenance.type
+  schedule = var.glue_trigger_iceberg_maintenance.schedule
+
+  actions {
+    job_name = aws_glue_job.iceberg_maintenance_job.name
+  }
+}
+
 resource "aws_glue_workflow" "openpowerlifting" {
   name                = var.glue_workflow_openpowerlifting.name
   description         = var.glue_workflow_openpowerlifting.description
@@ -50,12 +50,18 @@ resource "aws_lambda_function" "openpowerlifting_ingest" {
   timeout          = var.lambda_function_openpowerlifting.timeout
   source_code_hash = data.archive_file.openpowerlifting_ingest_zip.output_base64sha256
 
+  ephemeral_storage {
+    size = var.lambda_function_openpowerlifting.ephemeral_storage
+  }
+
   environment {
     variables = {
       URL = var.lambda_function_openpowerlifting.url
       BUCKET = aws_s3_bucket.raw_data.bucket
       SNS_TOPIC_ARN = aws_sns_topic.lambda_results.arn
       LAMBDA = var.lambda_function_openpowerlifting.function_name
+      WRITE_PARQUET = tostring(var.lambda_function_openpowerlifting.write_parquet)
+      VALIDATE_ROWS = tostring(var.lambda_function_openpowerlifting.validate_rows)
     }
   }
 
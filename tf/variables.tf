@@ -130,6 +130,20 @@ variable "glue_table_openpowerlifting_raw" {
   })
 }
 
+variable "glue_table_openpowerlifting_raw_parquet" {
+  type = object({
+    name = string
+    database = string
+    table_type = string
+    classification = string
+    s3_prefix = string
+    input_format = string
+    output_format = string
+    serialization_library = string
+    projection_year_range = string
+  })
+}
+
 
 # Glue ETL jobs, workflows, and triggers
 
@@ -170,6 +184,31 @@ variable "glue_job_openpowerlifting_cleanse" {
   })
 }
 
+variable "glue_job_iceberg_maintenance" {
+  type = object({
+    name              = string
+    description       = string
+    glue_version      = string
+    max_retries       = number
+    timeout           = number
+    number_of_workers = number
+    worker_type       = string
+    execution_class   = string
+    command           = string
+    script            = string
+    s3_key            = string
+    default_arguments = map(string)
+  })
+}
+
+variable "glue_trigger_iceberg_maintenance" {
+  type = object({
+    name = string
+    type = string
+    schedule = string
+  })
+}
+
 variable "glue_workflow_openpowerlifting" {
   type = object({
     name = string
@@ -308,7 +347,10 @@ variable "lambda_function_openpowerlifting" {
     memory_size      = number
     publish          = bool
     timeout          = number
+    ephemeral_storage = number
     url              = string
+    write_parquet    = bool
+    validate_rows    = bool
   })
 }
 